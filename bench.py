@@ -0,0 +1,377 @@
+#!/bin/env python
+# -*- encoding: utf-8 -*-
+################################################################################
+## TexPack benchmark suite
+##
+## Generates synthetic sprite sets, times each layout and each pipeline stage,
+## and optionally saves or compares JSON baselines to detect regressions.
+##
+## The peak memory of each stage is how far the resident set grew above its
+## size at the start of the stage, found by resetting the peak through
+## /proc/self/clear_refs; it is only measured on Linux.  Sprites are loaded
+## lazily, so the `load' stage only reads image headers; the `decode' stage
+## times decoding the pixels.
+##
+## Example:
+##   python bench.py --scale 1000 10000 --save baseline.json
+##   python bench.py --scale 1000 10000 --compare baseline.json
+################################################################################
+
+import logging
+log = logging.getLogger(__name__)
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from PIL import Image
+from PIL import ImageDraw
+
+import texpack
+from layouts import LAYOUTS
+from spritesheet import Sprite
+
+################################################################################
+
+def _size_icons(rng, i):
+    s = rng.choice((16, 24, 32, 32, 48, 64))
+    return s, s
+
+def _size_frames(rng, i):
+    ## Animations share one frame size across several frames
+    r = random.Random(i // 8)
+    return r.randint(24, 96), r.randint(32, 128)
+
+def _size_tiles(rng, i):
+    s = rng.choice((16, 32, 32, 32, 64))
+    return s, s
+
+KINDS = {
+    'icons': (_size_icons, 0.05, True),
+    'frames': (_size_frames, 0.10, True),
+    'tiles': (_size_tiles, 0.20, False),
+}
+
+def make_sprites(count, kind, seed=0):
+    """
+    Generate `count` synthetic sprite images with the size distribution named
+    by `kind`.  A fraction of the sprites are exact duplicates of earlier ones,
+    and sprites with a margin have transparent borders for trimming.
+    """
+    sizer, duplicates, margin = KINDS[kind]
+    rng = random.Random(seed)
+
+    sprites = []
+
+    for i in range(count):
+        if sprites and rng.random() < duplicates:
+            image = rng.choice(sprites).image.copy()
+
+        else:
+            w, h = sizer(rng, i)
+            image = Image.new('RGBA', (w, h), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(image)
+            color = tuple(rng.randint(0, 255) for _ in range(3)) + (255,)
+
+            if margin:
+                mx, my = rng.randint(0, w // 4), rng.randint(0, h // 4)
+                draw.ellipse((mx, my, w - mx - 1, h - my - 1), color)
+            else:
+                draw.rectangle((0, 0, w - 1, h - 1), color)
+                draw.line((0, 0, w - 1, h - 1), (255, 255, 255, 255))
+
+        sprites.append(Sprite(image, name='%s%06d.png' % (kind, i)))
+
+    return sprites
+
+def copy_sprites(sprites):
+    return [Sprite(spr.image, name=spr.name) for spr in sprites]
+
+################################################################################
+
+def read_memory():
+    """
+    Return the current and peak resident set size in bytes, or None if they
+    cannot be read on this platform.
+    """
+    sizes = {}
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    sizes[name] = int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        return None
+
+    if len(sizes) != 2:
+        return None
+
+    return sizes['VmRSS'], sizes['VmHWM']
+
+def reset_peak_memory():
+    """
+    Reset the peak resident set size to the current size, and return the
+    current size, or None if the peak cannot be reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return None
+
+    memory = read_memory()
+    return memory and memory[0]
+
+def efficiency(sheets):
+    used = sum(spr.w * spr.h for sheet in sheets for spr in sheet.sprites)
+    area = sum(sheet.size[0] * sheet.size[1] for sheet in sheets)
+    return float(used) / float(area) if area else 0.0
+
+class Bench(object):
+    """
+    Collects timings as a flat list of result records.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+
+    def measure(self, group, name, scale, kind, count, func, *fargs):
+        timing = []
+
+        start = reset_peak_memory()
+
+        with texpack.Timer('%s %s' % (group, name), timing.append):
+            value = func(*fargs)
+
+        seconds = timing[0].total_seconds()
+        memory = read_memory() if start is not None else None
+
+        result = {
+            'group': group,
+            'name': name,
+            'scale': scale,
+            'kind': kind,
+            'seconds': seconds,
+            'ops_per_sec': count / seconds if seconds > 0 else None,
+            'peak_memory': memory and memory[1] - start,
+        }
+
+        self.results.append(result)
+
+        log.info('%-8s %-10s %7d %-7s %10.4fs %12.1f ops/s', group, name,
+                 scale, kind, seconds, result['ops_per_sec'] or 0.0)
+
+        return value, result
+
+    def pack_args(self, prefix, layout, extrude=0):
+        argv = [prefix, '-', '--layout', layout, '--extrude', str(extrude),
+                '--max-size', str(self.args.max_size)]
+        return texpack.build_arg_parser().parse_args(argv)
+
+    def run_layouts(self, scale, kind, sprites):
+        for name in sorted(LAYOUTS):
+            if self.args.layouts and name not in self.args.layouts:
+                continue
+
+            args = self.pack_args('', name)
+
+            try:
+                sheets, result = self.measure('layout', name, scale, kind,
+                    len(sprites), texpack.build_sprite_sheets, args,
+                    copy_sprites(sprites))
+            except NotImplementedError:
+                log.info('%-8s %-10s skipped (not implemented)', 'layout', name)
+                continue
+
+            result['sheets'] = len(sheets)
+            result['efficiency'] = efficiency(sheets)
+
+    def run_stages(self, scale, kind, sprites, tempdir):
+        stages = self.args.stages
+        count = len(sprites)
+        srcdir = os.path.join(tempdir, 'src')
+        prefix = os.path.join(tempdir, 'out', 'sheet')
+
+        def wanted(name):
+            return not stages or name in stages
+
+        def save_sources():
+            os.makedirs(srcdir)
+            for spr in sprites:
+                spr.image.save(os.path.join(srcdir, spr.name))
+
+        save_sources()
+
+        if wanted('load'):
+            work, _ = self.measure('stage', 'load', scale, kind, count,
+                                   texpack.load_sprites, [srcdir])
+        else:
+            work = copy_sprites(sprites)
+
+        if wanted('decode'):
+            self.measure('stage', 'decode', scale, kind, count,
+                         lambda: [spr.image for spr in work])
+
+        if wanted('mask'):
+            self.measure('stage', 'mask', scale, kind, count,
+                         texpack.mask_sprites, work, 'auto')
+
+        if wanted('trim'):
+            self.measure('stage', 'trim', scale, kind, count,
+                         texpack.trim_sprites, work)
+
+        if wanted('alias'):
+            (work, _), _ = self.measure('stage', 'alias', scale, kind,
+                                        len(work), texpack.alias_sprites,
+                                        work, 0)
+
+        ## Extruded edges are drawn while compositing
+        args = self.pack_args(prefix, self.args.layout,
+                              1 if wanted('extrude') else 0)
+
+        sheets, result = self.measure('stage', 'pack', scale, kind, len(work),
+                                      texpack.build_sprite_sheets, args, work)
+        result['sheets'] = len(sheets)
+        result['efficiency'] = efficiency(sheets)
+
+        if wanted('composite') or wanted('save'):
+            textures, _ = self.measure('stage', 'composite', scale, kind,
+                                       len(work), lambda: [
+                                           sheet.prepare() for sheet in sheets
+                                       ])
+
+            if wanted('save'):
+                os.makedirs(os.path.dirname(prefix))
+                self.measure('stage', 'save', scale, kind, len(textures),
+                             lambda: [
+                                 texture.save('%s%d.png' % (prefix, i))
+                                 for i, texture in enumerate(textures)
+                             ])
+
+    def run(self):
+        for scale in self.args.scale:
+            for kind in self.args.kinds:
+                log.info('generating %d %s', scale, kind)
+                sprites = make_sprites(scale, kind, self.args.seed)
+
+                self.run_layouts(scale, kind, sprites)
+
+                tempdir = tempfile.mkdtemp(prefix='texpack-bench-')
+                try:
+                    self.run_stages(scale, kind, sprites, tempdir)
+                finally:
+                    shutil.rmtree(tempdir, ignore_errors=True)
+
+        return self.results
+
+################################################################################
+
+## Memory growth below this many bytes is page-level noise, not a regression
+MEMORY_SLACK = 1 << 20
+
+def result_key(result):
+    return '%(group)s/%(name)s/%(scale)d/%(kind)s' % result
+
+def compare_results(baseline, results, threshold):
+    """
+    Compare results against a baseline and return a list of regressions, that
+    is, results slower than the baseline, or with a higher peak memory, by more
+    than `threshold` (a fraction), or with lower packing efficiency.
+    """
+    base = dict((result_key(r), r) for r in baseline)
+    regressions = []
+
+    for result in results:
+        key = result_key(result)
+        old = base.get(key)
+
+        if old is None:
+            continue
+
+        if old['seconds'] > 0 and \
+                result['seconds'] > old['seconds'] * (1.0 + threshold):
+            regressions.append('%s: %.4fs -> %.4fs' % (
+                key, old['seconds'], result['seconds']))
+
+        if old.get('peak_memory') is not None and result.get('peak_memory') is not None and \
+                result['peak_memory'] > old['peak_memory'] * (1.0 + threshold) + MEMORY_SLACK:
+            regressions.append('%s: peak memory %d -> %d bytes' % (
+                key, old['peak_memory'], result['peak_memory']))
+
+        if 'efficiency' in old and \
+                result.get('efficiency', 0.0) < old['efficiency'] - 1e-9:
+            regressions.append('%s: efficiency %.4f -> %.4f' % (
+                key, old['efficiency'], result['efficiency']))
+
+    return regressions
+
+################################################################################
+
+def build_arg_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(usage='%(prog)s [options]')
+
+    parser.add_argument('--scale', type=int, nargs='+', default=[1000], metavar='COUNT',
+                        help="Number of sprites per synthetic set. (default: %(default)s)")
+    parser.add_argument('--kinds', nargs='+', default=sorted(KINDS), choices=sorted(KINDS),
+                        metavar='KIND', help="Sprite size distributions to generate. "
+                        "(default: %(default)s)")
+    parser.add_argument('--layouts', nargs='+', choices=sorted(LAYOUTS), metavar='TYPE',
+                        help="Layouts to time. (default: all)")
+    parser.add_argument('--layout', default='shelf', choices=sorted(LAYOUTS), metavar='TYPE',
+                        help="Layout used for the pipeline stages. (default: %(default)s)")
+    parser.add_argument('--stages', nargs='+', metavar='STAGE',
+                        choices=['load','decode','mask','trim','alias','extrude','composite','save'],
+                        help="Pipeline stages to time; packing is always timed. (default: all)")
+    parser.add_argument('--max-size', type=int, default=4096, metavar='SIZE',
+                        help="Maximum sheet dimensions. (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed for sprite generation. (default: %(default)s)")
+    parser.add_argument('--save', metavar='FILE',
+                        help="Save results to %(metavar)s as a JSON baseline.")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Compare results with the JSON baseline in %(metavar)s.")
+    parser.add_argument('--threshold', type=float, default=0.10, metavar='FRACTION',
+                        help="Slowdown that counts as a regression. (default: %(default)s)")
+
+    return parser
+
+def main(*argv):
+    args = build_arg_parser().parse_args(argv)
+
+    results = Bench(args).run()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare_results(baseline, results, args.threshold)
+
+        for line in regressions:
+            log.warning('regression: %s', line)
+
+        if regressions:
+            return 1
+
+    return 0
+
+################################################################################
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(*sys.argv[1:]))
+
+################################################################################
+## EOF
+################################################################################
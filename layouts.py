@@ -2,9 +2,11 @@
 ################################################################################
 ## TexPack layout engine
 ##
-## Implements selected versions of the Shelf, MaxRects, and Skyline algorithms
+## Implements selected versions of the Shelf, MaxRects, Guillotine, and Skyline
+## algorithms
 ## detailed in the paper "A Thousand Ways to Pack the Bin" by Jukka Jylänki[1],
-## as well as a transpose variant of Shelf here called "Stack".
+## as well as a transpose variant of Shelf here called "Stack", and a "Bitmap"
+## layout that nests sprites by their alpha masks.
 ##
 ## [1] http://clb.demon.fi/files/RectangleBinPack.pdf
 ################################################################################
@@ -14,6 +16,8 @@ __all__ = ['get_layout']
 import logging
 log = logging.getLogger(__name__)
 
+import bisect
+
 from spritesheet import Rect
 
 ################################################################################
@@ -21,9 +25,37 @@ from spritesheet import Rect
 class Layout(object):
     """
     Base class for rectangle layout algorithms.
+
+    Layouts are deterministic: the same sprites in the same order are always
+    placed the same way.  Ties between equal scores in `get_best` go to the
+    earliest sprite in the list, and then:
+
+    - shelf and stack: to the current orientation over the rotated one, and
+      then to the shortest shelf tall enough, and the oldest of those.
+    - max-rects and guillotine: to the oldest free rect, and then to the
+      current orientation over the rotated one in the same free rect, so a
+      rotated fit in an older free rect wins over an unrotated one in a newer
+      free rect.
+    - bitmap: there are no scores; the first sprite that fits at all is
+      placed, at the top-most and then left-most position in either
+      orientation, and in the current orientation if both have that position.
     """
 
+    RULES = ()
+    SPLIT_RULES = ()
+
+    ## Whether sprite rects may overlap
+    overlapping = False
+
     def __init__(self, sheet):
+        if sheet.rule is not None and sheet.rule not in self.RULES:
+            raise ValueError('%s does not support rule %r' %
+                             (type(self).__name__, sheet.rule))
+
+        if sheet.split_rule is not None and sheet.split_rule not in self.SPLIT_RULES:
+            raise ValueError('%s does not support split rule %r' %
+                             (type(self).__name__, sheet.split_rule))
+
         self.sheet = sheet
         self.clear()
 
@@ -37,6 +69,9 @@ class Layout(object):
         raise NotImplementedError('use a subclass of Layout')
 
     def add(self, *sprites):
+        if self.sheet.online:
+            return self.add_online(*sprites)
+
         placed = []
         remain = list(sprites)
 
@@ -49,6 +84,23 @@ class Layout(object):
 
         return placed, remain
 
+    def add_online(self, *sprites):
+        """
+        Place sprites in the given order, without searching the remaining
+        sprites for the best one to place next.
+        """
+        placed = []
+        remain = []
+
+        for spr in sprites:
+            i, pos, rot = self.get_best([spr])
+            if i is not None and self.place(spr, pos, rot):
+                placed.append(spr)
+            else:
+                remain.append(spr)
+
+        return placed, remain
+
     def debug_draw(self, image, draw):
         pass
 
@@ -57,15 +109,27 @@ class Layout(object):
 class ShelfLayout(Layout):
     """
     A basic layout that arranges rects in order on progressively higher rows or
-    "shelves".  When each rect is placed, if it does not fit on the current
+    "shelves".  When each rect is placed, if it does not fit on an existing
     shelf, a new shelf is created at the top of the tallest item.
+
+    Shelf choice rules: 'baf' (Best Area Fit, least wasted shelf area, the
+    default), 'nf' (Next Fit, only the newest shelf), 'ff' (First Fit, the
+    oldest shelf with room), and 'bhf' (Best Height Fit, the lowest shelf with
+    room).
+
+    Shelves are indexed by height, so shelves too short for a rect are skipped
+    by bisection.  'bhf' stops at the first shelf with room in that order, but
+    'baf' and 'ff' still score every shelf tall enough for each rect.
     """
 
+    RULES = ('baf', 'nf', 'ff', 'bhf')
+
     class Slice(object):
         def __init__(self, start=0, size=0):
             self.start = start
             self.size = size
             self.max = 0
+            self.order = None
             self.rects = []
 
         def place(self, rect):
@@ -80,61 +144,116 @@ class ShelfLayout(Layout):
     def clear(self):
         self.size = 0
         self.slices = []
+        self.index = []
+        self.index_slices = []
+
+    def extents(self, w, h):
+        """
+        Return the extents of a w x h rect along and across the shelves.
+        """
+        return w, h
+
+    def limits(self):
+        """
+        Return the sheet extents along and across the shelves.
+        """
+        return self.sheet.bounds
+
+    def candidates(self, across):
+        """
+        Yield the shelves at least `across` high, lowest and then oldest first.
+        """
+        if (self.sheet.rule or 'baf') == 'nf':
+            for shelf in self.slices[-1:]:
+                if shelf.max >= across:
+                    yield shelf
+            return
+
+        for i in range(bisect.bisect_left(self.index, (across, -1)), len(self.index_slices)):
+            yield self.index_slices[i]
+
+    def score(self, shelf, along, across):
+        """
+        Score placing a rect on `shelf`, or on a new shelf if `shelf` is None.
+        Lower scores are better; returns None if the rect does not fit.
+        """
+        rule = self.sheet.rule or 'baf'
+        mx, my = self.limits()
+
+        if shelf is not None:
+            if shelf.size + along > mx or across > shelf.max:
+                return None
+
+            waste = (mx - shelf.size - along) * shelf.max + \
+                    along * (shelf.max - across)
+
+            if rule == 'baf':
+                return waste,
+            elif rule == 'bhf':
+                return 0, shelf.max - across
+            else:
+                return 0, shelf.order, waste
 
-    def should_rotate(self, spr, shelf):
-        if shelf:
-            return self.sheet.rotate and (spr.w > spr.h) and (spr.w <= shelf.max)
         else:
-            return self.sheet.rotate and (spr.h > spr.w)
+            if self.slices and self.size + across > my:
+                return None
 
-    def score(self, spr, shelf, mx):
-        if shelf:
-            if shelf.size + spr.w <= mx and spr.h <= shelf.max:
-                return (mx - shelf.size - spr.w) * shelf.max + \
-                        spr.w * (shelf.max - spr.h)
-        else:
-            if self.size + spr.h <= mx:
-                return (mx - spr.w) * spr.h
+            waste = (mx - along) * across
 
-    def score_rotate(self, spr, shelf, mx):
-        rotate = self.should_rotate(spr, shelf)
-        if rotate: spr.rotate()
-        return self.score(spr, shelf, mx), rotate
+            if rule == 'baf':
+                return waste,
+            else:
+                return 1, 0, waste
 
-    def get_best(self, sprites):
-        maxw, maxh = self.sheet.size
+    def find_shelf(self, along, across):
+        rule = self.sheet.rule or 'baf'
+        best, best_score = None, None
 
-        best = None, None, None
-        best_score = None
+        for shelf in self.candidates(across):
+            score = self.score(shelf, along, across)
 
-        for i, spr in enumerate(sprites):
-            if spr.w > maxw or spr.h > maxh:
-                continue
+            if score is not None and (best_score is None or score < best_score):
+                best, best_score = shelf, score
 
-            best_shelf = None
+                if rule == 'bhf':
+                    ## No later shelf is any lower
+                    break
 
-            for shelf in self.slices:
-                score, rotate = self.score_rotate(spr, shelf, maxw)
+        if best is None:
+            ## No room on existing shelves
+            best_score = self.score(None, along, across)
+            if best_score is not None:
+                best = self.Slice(self.size)
 
-                if score is not None and (
-                    best_shelf is None or score < best_shelf[1]
-                ):
-                    best_shelf = shelf, score
+        return best, best_score
+
+    def get_best(self, sprites):
+        mx, my = self.limits()
+
+        best = None, None, None
+        best_score = None
+        found = {}
 
-            if best_shelf is None:
-                ## No room on existing shelves
+        for i, spr in enumerate(sprites):
+            for rotate in (False, True):
+                if rotate and not (self.sheet.rotate and spr.w != spr.h):
+                    continue
 
-                score, rotate = self.score_rotate(spr, None, maxh)
+                w, h = (spr.h, spr.w) if rotate else (spr.w, spr.h)
+                along, across = self.extents(w, h)
 
-                if self.slices and score is None:
-                    ## No room for new shelf
+                if along > mx or across > my:
                     continue
 
-                best_shelf = self.Slice(self.size), score
+                ## Sprites of the same size find the same shelf
+                if (along, across) not in found:
+                    found[along, across] = self.find_shelf(along, across)
+
+                shelf, score = found[along, across]
 
-            if best_score is None or best_shelf[1] < best_score:
-                best = i, best_shelf[0], rotate ^ spr.rotated
-                best_score = best_shelf[1]
+                if score is not None and (best_score is None or score < best_score):
+                    best = i, shelf, spr.rotated ^ rotate
+                    best_score = score
 
         return best
 
@@ -146,9 +265,15 @@ class ShelfLayout(Layout):
 
         self.size = max(self.size, shelf.start + shelf.max)
 
-        if shelf not in self.slices:
+        if shelf.order is None:
+            shelf.order = len(self.slices)
             self.slices.append(shelf)
 
+            key = shelf.max, shelf.order
+            i = bisect.bisect_left(self.index, key)
+            self.index.insert(i, key)
+            self.index_slices.insert(i, shelf)
+
         return True
 
 ################################################################################
@@ -158,13 +283,7 @@ class StackLayout(ShelfLayout):
     Like ShelfLayout, but arranges rects in columns.
     """
 
-    class Slice(object):
-        def __init__(self, start=0, size=0):
-            self.start = start
-            self.size = size
-            self.max = 0
-            self.rects = []
-
+    class Slice(ShelfLayout.Slice):
         def place(self, rect):
             self.rects.append(rect)
             rect.left = self.start
@@ -174,69 +293,101 @@ class StackLayout(ShelfLayout):
                 self.max = rect.width
             return rect
 
-    def clear(self):
-        self.size = 0
-        self.slices = []
+    def extents(self, w, h):
+        return h, w
 
-    def should_rotate(self, spr, shelf):
-        if shelf:
-            return self.sheet.rotate and (spr.h > spr.w) and (spr.h <= shelf.max)
-        else:
-            return self.sheet.rotate and (spr.w > spr.h)
-
-    def score(self, spr, shelf, mx):
-        if shelf:
-            if shelf.size + spr.h <= mx and spr.w <= shelf.max:
-                return (mx - shelf.size - spr.h) * shelf.max + \
-                        spr.h * (shelf.max - spr.w)
-        else:
-            if self.size + spr.w <= mx:
-                return (mx - spr.h) * spr.w
+    def limits(self):
+        w, h = self.sheet.bounds
+        return h, w
 
 ################################################################################
 
-import os
-
-if not os.path.isdir('maxdbg'):
-    os.makedirs('maxdbg')
-
 class MaxRectsLayout(Layout):
     """
     A layout that arranges rects by subdividing free space into overlapping
     regions.  When each rect is placed, its area is removed from the remaining
     free-space rects.
+
+    Placement rules: 'bssf' (Best Short Side Fit, the default), 'blsf' (Best
+    Long Side Fit), 'baf' (Best Area Fit), 'bl' (Bottom-Left), and 'cp'
+    (Contact Point).
     """
 
+    RULES = ('bssf', 'blsf', 'baf', 'bl', 'cp')
+
     def clear(self):
-        w, h = self.sheet.size
+        w, h = self.sheet.bounds
         self.used_rects = []
         self.free_rects = [Rect(w, h)]
         self.debug_image_count = 0
 
+    def score(self, free, w, h):
+        """
+        Score placing a w x h rect at the top-left of `free` according to the
+        sheet's placement rule.  Lower scores are better.
+        """
+        rule = self.sheet.rule or 'bssf'
+        dx, dy = free.w - w, free.h - h
+
+        if rule == 'bssf':
+            ## Best Short Side Fit
+            return min(dx, dy), max(dx, dy)
+        elif rule == 'blsf':
+            ## Best Long Side Fit
+            return max(dx, dy), min(dx, dy)
+        elif rule == 'baf':
+            ## Best Area Fit
+            return free.w * free.h - w * h, min(dx, dy)
+        elif rule == 'bl':
+            ## Bottom-Left (Tetris-style; "bottom" is y = 0 here)
+            return free.y + h, free.x
+        else:
+            ## Contact Point
+            return -self.contact(free.x, free.y, w, h),
+
+    def contact(self, x, y, w, h):
+        """
+        Return the length of the edges of a w x h rect at (x, y) that touch the
+        sheet border or already placed rects.
+        """
+        maxw, maxh = self.sheet.bounds
+        score = 0
+
+        if x == 0 or x + w == maxw:
+            score += h
+        if y == 0 or y + h == maxh:
+            score += w
+
+        for used in self.used_rects:
+            if used.x == x + w or used.x + used.w == x:
+                score += max(0, min(used.y + used.h, y + h) - max(used.y, y))
+            if used.y == y + h or used.y + used.h == y:
+                score += max(0, min(used.x + used.w, x + w) - max(used.x, x))
+
+        return score
+
     def search(self, rect):
-        bssf, blsf = None, None
+        best, best_score = None, None
         rotate = False
-        best = None
 
         for free in self.free_rects:
             if free.w >= rect.w and free.h >= rect.h:
-                dx, dy = free.w - rect.w, free.h - rect.h
-                ssf, lsf = min(dx, dy), max(dx, dy)
+                score = self.score(free, rect.w, rect.h)
 
-                if best is None or ssf < bssf or (ssf == bssf and lsf < blsf):
+                if best is None or score < best_score:
                     best = Rect(rect.w, rect.h, free.x, free.y)
-                    bssf, blsf = ssf, lsf
+                    best_score = score
+                    rotate = False
 
             if self.sheet.rotate and free.h >= rect.w and free.w >= rect.h:
-                dx, dy = free.w - rect.h, free.h - rect.w
-                ssf, lsf = min(dx, dy), max(dx, dy)
+                score = self.score(free, rect.h, rect.w)
 
-                if best is None or ssf < bssf or (ssf == bssf and lsf < blsf):
+                if best is None or score < best_score:
                     best = Rect(rect.h, rect.w, free.x, free.y)
-                    bssf, blsf = ssf, lsf
+                    best_score = score
                     rotate = True
 
-        return best, bssf, blsf, rotate
+        return best, best_score, rotate
 
     def split(self, free, rect):
         if (rect.x >= free.x + free.w or rect.x + rect.w <= free.x or
@@ -279,32 +430,26 @@ class MaxRectsLayout(Layout):
 
         for i, spr in enumerate(sprites):
             ## find position
-            pos, bssf, blsf, rotate = self.search(spr)
+            pos, score, rotate = self.search(spr)
 
             if not (pos and self.sheet.check(pos)):
                 continue
 
-            if rotate:
-                if self.sheet.rotate:
-                    spr.rotate()
-                else:
-                    continue
-
-            if best_score is None or (bssf, blsf) < best_score:
-                best = i, pos, spr.rotated
-                best_score = bssf, blsf
+            if best_score is None or score < best_score:
+                best = i, pos, spr.rotated ^ rotate
+                best_score = score
 
         return best
 
     def place(self, sprite, position, rotate=False):
+        if sprite.rotated ^ rotate:
+            sprite.rotate()
+
         sprite.x, sprite.y = position.x, position.y
 
         if not self.sheet.check(sprite):
             return False
 
-        if sprite.rotated ^ rotate:
-            sprite.rotate()
-
         ## split free nodes
         for i, free in reversed(list(enumerate(self.free_rects))):
             if free.intersects(sprite) and self.split(free, sprite):
@@ -328,6 +473,328 @@ class MaxRectsLayout(Layout):
 
 ################################################################################
 
+class GuillotineLayout(Layout):
+    """
+    A layout that keeps free space as a list of disjoint rects.  When each rect
+    is placed in a free rect, the L-shaped remainder is cut in two along one
+    axis, and adjacent free rects that line up are merged again.
+
+    Free-rect choice rules: 'baf' (Best Area Fit, the default), 'bssf' (Best
+    Short Side Fit), and 'blsf' (Best Long Side Fit).
+
+    Split rules: 'slas' (Shorter Leftover Axis, the default), 'llas' (Longer
+    Leftover Axis), 'sas' (Shorter Axis), 'las' (Longer Axis), 'minas'
+    (Minimize Area), and 'maxas' (Maximize Area).
+    """
+
+    RULES = ('baf', 'bssf', 'blsf')
+    SPLIT_RULES = ('slas', 'llas', 'sas', 'las', 'minas', 'maxas')
+
+    def clear(self):
+        w, h = self.sheet.bounds
+        self.used_rects = []
+        self.free_rects = [Rect(w, h)]
+
+    def score(self, free, w, h):
+        rule = self.sheet.rule or 'baf'
+        dx, dy = free.w - w, free.h - h
+
+        if rule == 'baf':
+            return free.w * free.h - w * h, min(dx, dy)
+        elif rule == 'bssf':
+            return min(dx, dy), max(dx, dy)
+        else:
+            return max(dx, dy), min(dx, dy)
+
+    def search(self, rect):
+        best, best_score = None, None
+        rotate = False
+
+        for free in self.free_rects:
+            if free.w >= rect.w and free.h >= rect.h:
+                score = self.score(free, rect.w, rect.h)
+
+                if best is None or score < best_score:
+                    best = Rect(rect.w, rect.h, free.x, free.y)
+                    best_score = score
+                    rotate = False
+
+            if self.sheet.rotate and free.h >= rect.w and free.w >= rect.h:
+                score = self.score(free, rect.h, rect.w)
+
+                if best is None or score < best_score:
+                    best = Rect(rect.h, rect.w, free.x, free.y)
+                    best_score = score
+                    rotate = True
+
+        return best, best_score, rotate
+
+    def get_best(self, sprites):
+        best = None, None, None
+        best_score = None
+
+        for i, spr in enumerate(sprites):
+            pos, score, rotate = self.search(spr)
+
+            if not (pos and self.sheet.check(pos)):
+                continue
+
+            if best_score is None or score < best_score:
+                best = i, pos, spr.rotated ^ rotate
+                best_score = score
+
+        return best
+
+    def split_horizontal(self, free, rect):
+        """
+        Decide whether the remainder of `free` around `rect` is cut along a
+        horizontal line, giving the full width to the lower free rect.
+        """
+        rule = self.sheet.split_rule or 'slas'
+        dx, dy = free.w - rect.w, free.h - rect.h
+
+        if rule == 'slas':
+            return dx <= dy
+        elif rule == 'llas':
+            return dx > dy
+        elif rule == 'sas':
+            return free.w <= free.h
+        elif rule == 'las':
+            return free.w > free.h
+        elif rule == 'minas':
+            return rect.w * dy > dx * rect.h
+        else:
+            return rect.w * dy <= dx * rect.h
+
+    def split(self, free, rect):
+        """
+        Add the free rects left around `rect` in `free`, and return them.
+        """
+        horizontal = self.split_horizontal(free, rect)
+
+        below = Rect(free.w if horizontal else rect.w, free.h - rect.h,
+                     free.x, free.y + rect.h)
+        right = Rect(free.w - rect.w, rect.h if horizontal else free.h,
+                     free.x + rect.w, free.y)
+
+        added = [new for new in (below, right) if new.w > 0 and new.h > 0]
+        self.free_rects.extend(added)
+        return added
+
+    def merge(self, rects):
+        """
+        Merge each of `rects` with any free rect it forms a single rect with.
+        Other free rects were merged when they were added, so only `rects`,
+        and the rects they grow into, are checked.  The earlier of two merged
+        rects in the list is kept.
+        """
+        pending = list(rects)
+
+        while pending:
+            r1 = pending.pop()
+
+            for r2 in self.free_rects:
+                if r2 is r1:
+                    continue
+
+                if r1.x == r2.x and r1.w == r2.w and (
+                    r1.y + r1.h == r2.y or r2.y + r2.h == r1.y
+                ):
+                    y, h = min(r1.y, r2.y), r1.h + r2.h
+                    x, w = r1.x, r1.w
+                elif r1.y == r2.y and r1.h == r2.h and (
+                    r1.x + r1.w == r2.x or r2.x + r2.w == r1.x
+                ):
+                    x, w = min(r1.x, r2.x), r1.w + r2.w
+                    y, h = r1.y, r1.h
+                else:
+                    continue
+
+                i = next(k for k, r in enumerate(self.free_rects) if r is r1)
+                j = next(k for k, r in enumerate(self.free_rects) if r is r2)
+                keep, drop = (r1, r2) if i < j else (r2, r1)
+
+                keep.x, keep.y, keep.w, keep.h = x, y, w, h
+                self.free_rects.pop(max(i, j))
+
+                pending = [r for r in pending if r is not drop]
+                pending.append(keep)
+                break
+
+    def place(self, sprite, position, rotate=False):
+        if sprite.rotated ^ rotate:
+            sprite.rotate()
+
+        sprite.x, sprite.y = position.x, position.y
+
+        if not self.sheet.check(sprite):
+            return False
+
+        for i, free in enumerate(self.free_rects):
+            if free.x == sprite.x and free.y == sprite.y and free.contains(sprite):
+                break
+        else:
+            return False
+
+        self.free_rects.pop(i)
+        self.merge(self.split(free, sprite))
+
+        log.debug('%r', sprite)
+        self.used_rects.append(sprite)
+        return True
+
+    def debug_draw(self, image, draw):
+        for r in self.free_rects:
+            x0, y0, x1, y1 = r.left, r.top, r.right, r.bottom
+            draw.rectangle((x0, y0, x1, y1), None, '#0000ff')
+
+################################################################################
+
+class BitmapLayout(Layout):
+    """
+    A layout that packs coarse alpha occupancy bitmaps instead of rects, so
+    sprites can interlock wherever their visible pixels do not overlap.
+
+    The sheet is divided into square cells of `sheet.cell_size` pixels, and each
+    row of cells is kept as an integer bitset.  A sprite's mask marks every cell
+    that holds a visible pixel of its image or extruded edges; placed masks are
+    also grown by the padding on every side.  Sprites are taken in the given order and placed
+    at the top-most, then left-most position where their mask does not collide.
+
+    Sprite rects may overlap, so renderers must draw these sprites with meshes
+    or alpha testing rather than plain quads.
+    """
+
+    overlapping = True
+
+    def clear(self):
+        w, h = self.sheet.bounds
+        size = self.sheet.cell_size
+        if size < 1:
+            raise ValueError('cell size must be positive, not %r' % size)
+
+        self.cols = max(0, w // size)
+        self.rows = [0] * max(0, h // size)
+        self.full = set() ## sprites known not to fit; occupancy only grows
+
+    def mask(self, spr, rotate=False):
+        """
+        Return the cell masks of `spr` in its current (or the other, if
+        `rotate`) orientation: its width in cells, a list of bitsets without
+        padding, the margin in cells on the left and top of the padded mask,
+        and a list of bitsets with padding.
+        """
+        from PIL import Image
+        from PIL import ImageFilter
+
+        size = self.sheet.cell_size
+        rotated = spr.rotated ^ rotate
+        key = rotated, size, spr.extrude, spr.pad
+
+        if not hasattr(spr, 'cell_masks'):
+            spr.cell_masks = {}
+
+        if key not in spr.cell_masks:
+            image = spr.image
+            if rotate:
+                image = image.transpose(Image.ROTATE_90 if rotated else Image.ROTATE_270)
+
+            e, p = spr.extrude, spr.pad
+            iw, ih = image.size
+            cw = (iw + e * 2 + p + size - 1) // size
+            ch = (ih + e * 2 + p + size - 1) // size
+            m = (p + size - 1) // size
+
+            alpha = image.getchannel('A').point(lambda a: 255 if a else 0)
+
+            def cells(margin, grow):
+                w, h = cw + margin, ch + margin
+                mask = Image.new('L', (w * size, h * size), 0)
+                mask.paste(alpha, (margin * size + e, margin * size + e))
+                if grow:
+                    mask = mask.filter(ImageFilter.MaxFilter(grow * 2 + 1))
+                mask = mask.resize((w, h), Image.BOX).point(lambda a: 255 if a else 0)
+                data = mask.tobytes()
+                return [sum(1 << x for x in range(w) if data[y * w + x])
+                        for y in range(h)]
+
+            spr.cell_masks[key] = cw, cells(0, e), m, cells(m, e + p)
+
+        return spr.cell_masks[key]
+
+    def search(self, cw, mask):
+        """
+        Return the top-most, then left-most free cell position for `mask`.
+        """
+        rows = self.rows
+        valid = (1 << max(0, self.cols - cw + 1)) - 1
+        bits = [[x for x in range(cw) if row >> x & 1] for row in mask]
+
+        for y in range(len(rows) - len(mask) + 1):
+            blocked = 0
+
+            for r, xs in enumerate(bits):
+                occupied = rows[y + r]
+                if occupied:
+                    for x in xs:
+                        blocked |= occupied >> x
+
+            free = valid & ~blocked
+
+            if free:
+                return (free & -free).bit_length() - 1, y
+
+        return None
+
+    def get_best(self, sprites):
+        size = self.sheet.cell_size
+
+        for i, spr in enumerate(sprites):
+            if id(spr) in self.full:
+                continue
+
+            best, best_pos = None, None
+
+            for rotate in (False, True):
+                if rotate and not self.sheet.rotate:
+                    continue
+
+                cw, mask, _, _ = self.mask(spr, rotate)
+                pos = self.search(cw, mask)
+
+                if pos is not None and (best_pos is None or pos[::-1] < best_pos[::-1]):
+                    best, best_pos = rotate, pos
+
+            if best_pos is not None:
+                x, y = best_pos
+                return i, Rect(0, 0, x * size, y * size), spr.rotated ^ best
+
+            self.full.add(id(spr))
+
+        return None, None, None
+
+    def place(self, sprite, position, rotate=False):
+        if sprite.rotated ^ rotate:
+            sprite.rotate()
+
+        sprite.x, sprite.y = position.x, position.y
+
+        if not self.sheet.check(sprite):
+            return False
+
+        size = self.sheet.cell_size
+        _, _, m, grown = self.mask(sprite)
+        cx, cy = sprite.x // size - m, sprite.y // size - m
+
+        for r, row in enumerate(grown):
+            if 0 <= cy + r < len(self.rows):
+                self.rows[cy + r] |= row << cx if cx >= 0 else row >> -cx
+
+        log.debug('%r', sprite)
+        return True
+
+################################################################################
+
 class SkylineLayout(Layout):
     """
     """
@@ -344,6 +811,8 @@ LAYOUTS = {
     'shelf': ShelfLayout,
     'stack': StackLayout,
     'max-rects': MaxRectsLayout,
+    'guillotine': GuillotineLayout,
+    'bitmap': BitmapLayout,
     'skyline': SkylineLayout,
 }
 
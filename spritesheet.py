@@ -110,43 +110,224 @@ class Rect(object):
 ################################################################################
 
 from PIL import Image
+from PIL import ImageChops
 from PIL import ImageDraw
+import hashlib
 import os
 
 class Sprite(Rect):
+    """
+    A sprite image and its rect on a sheet.
+
+    A sprite created from a filename or file object only reads the image header
+    at first, or nothing if its `size` is given; the pixels are decoded when
+    `image` is first used, and can be dropped again with `release()` until the
+    image is replaced or changed.  A sprite created with a `box` is likewise
+    cropped from a region of a shared image on use.  A known content `digest`
+    may also be given to skip hashing the pixels.
+    """
+
     def __init__(self, image, *args, **kwargs):
+        name = kwargs.pop('name', None)
+        box = kwargs.pop('box', None)
+        size = kwargs.pop('size', None)
+        digest = kwargs.pop('digest', None)
+
         Rect.__init__(self, *args, **kwargs)
 
-        if str(image) == image:
-            self.filename = image
-            kwargs.setdefault('name', os.path.basename(image))
-            image = Image.open(image).convert('RGBA')
+        self.name = name
+        self.extrude = 0
+        self.pad = 0
+        self._source = None
+        self._box = None
+
+        if box is not None:
+            self._source = image
+            self._box = tuple(box)
+            size = box[2] - box[0], box[3] - box[1]
+
+        elif str(image) == image or hasattr(image, 'read'):
+            self._source = image
+            if str(image) == image:
+                self.filename = image
+                if self.name is None:
+                    self.name = os.path.basename(image)
+
+            if size is None:
+                ## Only reads the header
+                with Image.open(image) as header:
+                    size = header.size
+
+        else:
+            self.image = image
+
+        if self._source is not None:
+            self._image = None
+            self._rimage = None
+            self._digest = digest
+            self._size = tuple(size)
+            self.w, self.h = self._size
+            self.rotated = False
 
-        self.name = kwargs.get('name')
-        self.image = image
-        self.rotated = False
         self.x, self.y = 0, 0
 
+    def _load(self):
+        if self._image is None:
+            if self._box is not None:
+                self._image = self._source.crop(self._box)
+            else:
+                if hasattr(self._source, 'seek'):
+                    self._source.seek(0)
+                self._image = Image.open(self._source).convert('RGBA')
+        return self._image
+
+    @property
+    def loaded(self):
+        return self._image is not None
+
+    def release(self):
+        """
+        Drop the decoded pixels if they can be loaded again from the file.
+        """
+        if self._size is not None:
+            self._image = None
+            self._rimage = None
+
+    @property
+    def image_size(self):
+        """
+        Size of the (unrotated) image, without decoding it.
+        """
+        if self._size is not None:
+            return self._size
+        return self._image.size
+
     @property
     def image(self):
         if self.rotated:
-            if not hasattr(self, '_rimage') or self._rimage is None:
-                self._rimage = self._image.transpose(Image.ROTATE_90)
+            if self._rimage is None:
+                self._rimage = self._load().transpose(Image.ROTATE_90)
             return self._rimage
         else:
-            return self._image
+            return self._load()
 
     @image.setter
     def image(self, value):
         self._image = value
         self._rimage = None
+        self._digest = None
+        self._size = None ## no longer the file contents
         self.w, self.h = value.size
+        self.w += self.margin
+        self.h += self.margin
         self.rotated = False
 
+    @property
+    def digest(self):
+        """
+        Hex digest of the (unrotated) image content.
+        """
+        if self._digest is None:
+            image = self._load()
+            h = hashlib.sha1(('%s %dx%d ' % ((image.mode,) + image.size)).encode('ascii'))
+            h.update(image.tobytes())
+            self._digest = h.hexdigest()
+        return self._digest
+
+    @property
+    def margin(self):
+        """
+        Space around the image reserved for extruded edges and padding.  The
+        image is placed `extrude` pixels in from the top-left of the sprite
+        rect, which also includes `pad` pixels at the right and bottom.
+        """
+        return self.extrude * 2 + self.pad
+
+    def set_margin(self, extrude=0, pad=0):
+        grow = extrude * 2 + pad - self.margin
+        self.extrude = extrude
+        self.pad = pad
+        self.w += grow
+        self.h += grow
+
     def rotate(self):
         self.rotated = not self.rotated
         self.w, self.h = self.h, self.w
 
+    def paste(self, texture, offset=(0, 0)):
+        """
+        Draw the image and its extruded edges onto `texture` at the sprite's
+        position plus `offset`.
+        """
+        image = self.image
+        size = self.extrude
+        w, h = image.size
+        x, y = offset[0] + self.x + size, offset[1] + self.y + size
+
+        texture.paste(image, (x, y), image)
+
+        if size:
+            edges = [
+                ((0,  0,  1,1), (size,size), (x-size,y-size)),
+                ((0,  0,  w,1), (w,   size), (x,     y-size)),
+                ((w-1,0,  w,1), (size,size), (x+w,   y-size)),
+                ((0,  0,  1,h), (size,h   ), (x-size,y     )),
+                ((w-1,0,  w,h), (size,h   ), (x+w,   y     )),
+                ((0,  h-1,1,h), (size,size), (x-size,y+h   )),
+                ((0,  h-1,w,h), (w,   size), (x,     y+h   )),
+                ((w-1,h-1,w,h), (size,size), (x+w,   y+h   )),
+            ]
+
+            for box, edge_size, pos in edges:
+                edge = image.crop(box).resize(edge_size)
+                texture.paste(edge, pos, edge)
+
+def _shift(image, dx, dy):
+    shifted = Image.new(image.mode, image.size)
+    shifted.paste(image, (dx, dy))
+    return shifted
+
+## Orthogonal neighbours first, so they win over diagonal ones
+BLEED_NEIGHBOURS = [(1, 0), (-1, 0), (0, 1), (0, -1),
+                    (1, 1), (-1, 1), (1, -1), (-1, -1)]
+
+def bleed_texture(texture, radius):
+    """
+    Spread the colors of visible pixels of an RGBA texture up to `radius`
+    pixels into the fully transparent pixels around them, a ring at a time, so
+    that filtering never blends in the arbitrary colors of transparent pixels.
+    Alpha is unchanged.
+    """
+    alpha = texture.getchannel('A')
+    rgb = texture.convert('RGB')
+    empty = alpha.point([255] + [0] * 255)
+
+    for _ in range(radius):
+        filled = ImageChops.invert(empty)
+        grew = False
+
+        for dx, dy in BLEED_NEIGHBOURS:
+            mask = ImageChops.multiply(empty, _shift(filled, dx, dy))
+            box = mask.getbbox()
+
+            if box:
+                rgb.paste(_shift(rgb, dx, dy).crop(box), box, mask.crop(box))
+                empty = ImageChops.subtract(empty, mask)
+                grew = True
+
+        if not grew:
+            break
+
+    rgb.putalpha(alpha)
+    return rgb
+
+def premultiply_texture(texture):
+    """
+    Return an RGBA texture with its colors multiplied by alpha.
+    """
+    r, g, b, a = texture.split()
+    return Image.merge('RGBA', [ImageChops.multiply(c, a) for c in (r, g, b)] + [a])
+
 class Sheet(object):
     def __init__(self, **kwargs):
         layout = kwargs.get('layout')
@@ -155,6 +336,15 @@ class Sheet(object):
         rotate = kwargs.get('rotate', False)
         npot = kwargs.get('npot', False)
         square = kwargs.get('square', False)
+        rule = kwargs.get('rule')
+        split_rule = kwargs.get('split_rule')
+        padding = kwargs.get('padding', 0)
+        extrude = kwargs.get('extrude', 0)
+        border = kwargs.get('border', 0)
+        online = kwargs.get('online', False)
+        cell_size = kwargs.get('cell_size', 8)
+        bleed = kwargs.get('bleed', 0)
+        premultiply = kwargs.get('premultiply', False)
 
         try:
             min_size = int(min_size)
@@ -174,12 +364,23 @@ class Sheet(object):
         self.rotate = rotate
         self.npot = npot
         self.square = square
+        self.rule = rule
+        self.split_rule = split_rule
+        self.padding = padding
+        self.extrude = extrude
+        self.border = border
+        self.online = online
+        self.cell_size = cell_size
+        self.bleed = bleed
+        self.premultiply = premultiply
+        self.passes = 0
 
         self.clear()
 
     def clear(self):
         self.sprites = []
         self.size = self.min_size
+        self.finished = False
 
     def grow(self, gw=0, gh=0):
         maxw, maxh = self.max_size
@@ -205,13 +406,40 @@ class Sheet(object):
         log.debug('grow to %dx%d', w, h)
         return w > oldw or h > oldh
 
+    @property
+    def bounds(self):
+        """
+        Size of the area that layouts arrange sprites in.  This excludes the
+        border, and includes room for the padding after the last sprite in each
+        direction, since padding is only needed between sprites.
+        """
+        w, h = self.size
+        grow = self.padding - self.border * 2
+        return w + grow, h + grow
+
+    @property
+    def offset(self):
+        """
+        Position of the layout area on the texture.
+        """
+        return self.border, self.border
+
+    def frame(self, spr):
+        """
+        Return the area of the texture covered by the image of `spr`.
+        """
+        ox, oy = self.offset
+        size = spr.extrude
+        return Rect(spr.w - spr.margin, spr.h - spr.margin,
+                    ox + spr.x + size, oy + spr.y + size)
+
     def checkw(self, rect):
-        w, _ = self.size
+        w, _ = self.bounds
         rw = rect.x + rect.w
         return rw <= w
 
     def checkh(self, rect):
-        _, h = self.size
+        _, h = self.bounds
         rh = rect.y + rect.h
         return rh <= h
 
@@ -226,6 +454,7 @@ class Sheet(object):
             if sprites is None:
                 sprites = self.sprites
             self.layout = self.layout_type(self)
+            self.passes += 1
             placed, remain = self.layout.add(*sprites)
 
         return placed, remain
@@ -244,11 +473,17 @@ class Sheet(object):
         if w < minw: w = minw
         if h < minh: h = minh
 
+        w -= self.bounds[0] - self.size[0]
+        h -= self.bounds[1] - self.size[1]
+
         log.debug('guess starting size of %dx%d', w, h)
 
         return w, h
 
     def add(self, sprites):
+        for spr in sprites:
+            spr.set_margin(self.extrude, self.padding)
+
         temp = self.sprites + sprites
 
         gw, gh = self.guess_size(temp)
@@ -265,15 +500,22 @@ class Sheet(object):
             placed, remain = self.do_layout(temp)
 
         self.sprites = placed
+        self.finished = False
 
         return remain
 
-    def prepare(self, debug=None):
+    def finish(self):
+        """
+        Shrink the sheet to its final texture size and redo the layout to fit.
+        """
         log.debug('\t%r', self.size)
 
         minw = max(spr.x+spr.w for spr in self.sprites)
         minh = max(spr.y+spr.h for spr in self.sprites)
 
+        minw -= self.bounds[0] - self.size[0]
+        minh -= self.bounds[1] - self.size[1]
+
         if self.square:
             log.debug('enforce square texture')
             minw = minh = max(minw, minh)
@@ -292,20 +534,43 @@ class Sheet(object):
         log.debug('\t%r', self.size)
 
         ## redo layout with final size
-        self.do_layout(self.sprites)
+        placement = [(spr.x, spr.y, spr.rotated) for spr in self.sprites]
+        _, remain = self.do_layout(self.sprites)
+
+        if remain:
+            ## The old placement is known to fit the final size
+            log.debug('keep layout from before resize')
+            for spr, (x, y, rotated) in zip(self.sprites, placement):
+                if spr.rotated != rotated:
+                    spr.rotate()
+                spr.x, spr.y = x, y
+
+        self.finished = True
+
+    def prepare(self, debug=None):
+        if not self.finished:
+            self.finish()
 
         texture = Image.new('RGBA', self.size) # args.color_depth
 
         for spr in self.sprites:
             log.debug('\t%r %r %r %r', (spr.x, spr.y, spr.w, spr.h), spr.image.size, spr.image.mode, spr.rotated)
-            texture.paste(spr.image, (spr.x, spr.y), spr.image)
+            spr.paste(texture, self.offset)
+
+        if self.bleed:
+            texture = bleed_texture(texture, self.bleed)
+
+        if self.premultiply:
+            texture = premultiply_texture(texture)
 
         if debug:
             draw = ImageDraw.Draw(texture)
             color = debug
 
+            ox, oy = self.offset
+
             for spr in self.sprites:
-                x0, y0, x1, y1 = spr.left, spr.top, spr.right, spr.bottom
+                x0, y0, x1, y1 = spr.left+ox, spr.top+oy, spr.right+ox, spr.bottom+oy
                 draw.rectangle((x0, y0, x1, y1), None, color)
                 draw.text((x0+2, y0+2), spr.name, color)
                 if hasattr(spr, 'alias'):
@@ -6,6 +6,7 @@
 
 import texpack
 
+import os
 import unittest
 
 ################################################################################
@@ -38,6 +39,77 @@ class TrimTest(unittest.TestCase):
     def test_trim(self):
         texpack.main("test/test_trim_", "test-sprites", "--trim")
 
+class SourceTest(unittest.TestCase):
+    def setUp(self):
+        import glob
+        self.files = sorted(glob.glob("test-sprites/[ak]*.gif"))
+        if not os.path.isdir("test/sources"):
+            os.makedirs("test/sources")
+
+    def names(self, source):
+        return sorted(spr.name for spr in texpack.load_sprites([source]))
+
+    def test_zip(self):
+        import zipfile
+        with zipfile.ZipFile("test/sources/sprites.zip", 'w') as archive:
+            for f in self.files:
+                archive.write(f)
+        self.assertEqual(self.names("test/sources/sprites.zip"), self.names("test-sprites/[ak]*.gif"))
+        texpack.main("test/test_source_zip_", "test/sources/sprites.zip", "--trim")
+
+    def test_tar(self):
+        import tarfile
+        with tarfile.open("test/sources/sprites.tar.gz", 'w:gz') as archive:
+            for f in self.files:
+                archive.add(f)
+        self.assertEqual(self.names("test/sources/sprites.tar.gz"), self.names("test-sprites/[ak]*.gif"))
+
+    def test_manifest(self):
+        import json
+        sprites = texpack.load_sprites(self.files)
+        entries = [{'path': os.path.relpath(spr.filename, "test/sources"),
+                    'size': spr.image.size, 'digest': spr.digest} for spr in sprites]
+        with open("test/sources/sprites.json", 'w') as f:
+            json.dump({'sprites': entries}, f)
+        loaded = texpack.load_sprites(["test/sources/sprites.json"])
+        self.assertFalse(any(spr.loaded for spr in loaded))
+        self.assertEqual([spr.digest for spr in loaded], [spr.digest for spr in sprites])
+        self.assertFalse(any(spr.loaded for spr in loaded))
+        texpack.main("test/test_source_manifest_", "test/sources/sprites.json")
+
+class FramesTest(unittest.TestCase):
+    def setUp(self):
+        from PIL import Image
+        from PIL import ImageDraw
+        if not os.path.isdir("test/frames"):
+            os.makedirs("test/frames")
+        frames = []
+        for i in range(4):
+            image = Image.new('RGBA', (24, 16), (0, 0, 0, 0))
+            ImageDraw.Draw(image).rectangle((i * 4, 0, i * 4 + 7, 15), (255, 0, 0, 255))
+            frames.append(image)
+        frames[0].save("test/frames/anim.gif", save_all=True, append_images=frames[1:])
+        strip = Image.new('RGBA', (24 * 4, 16))
+        for i, image in enumerate(frames):
+            strip.paste(image, (24 * i, 0))
+        strip.save("test/frames/strip.png")
+
+    def index(self, prefix):
+        import json
+        with open(prefix + "0.idx") as f:
+            return json.load(f)
+
+    def test_frames(self):
+        texpack.main("test/test_frames_", "test/frames/anim.gif", "--frames", "--trim")
+        names = sorted(spr['name'] for spr in self.index("test/test_frames_")['sprites'])
+        self.assertEqual(names, ['anim.gif#%d' % i for i in range(4)])
+
+    def test_strip(self):
+        texpack.main("test/test_strip_", "test/frames/strip.png", "--strip=24x16")
+        sprites = self.index("test/test_strip_")['sprites']
+        self.assertEqual(len(sprites), 4)
+        self.assertTrue(all((spr['w'], spr['h']) == (24, 16) for spr in sprites))
+
 class AliasTest(unittest.TestCase):
     def test_alias_default(self):
         texpack.main("test/test_alias_default_", "test-sprites", "--alias")
@@ -45,6 +117,56 @@ class AliasTest(unittest.TestCase):
     def test_alias_custom(self):
         texpack.main("test/test_alias_custom_", "test-sprites", "--alias=0.5")
 
+class TilesTest(unittest.TestCase):
+    def test_tiles(self):
+        import json
+        from PIL import Image
+        texpack.main("test/test_tiles_", "test-sprites/[ak]*.gif", "--tiles=8", "--rotate")
+        with open("test/test_tiles_0.idx") as f:
+            index = json.load(f)
+        texture = Image.open("test/test_tiles_0.png").convert('RGBA')
+        for spr in index['sprites']:
+            image = Image.new('RGBA', (spr['w'], spr['h']))
+            for quad in spr['quads']:
+                tile = texture.crop((quad['x'], quad['y'],
+                                     quad['x'] + quad['w'], quad['y'] + quad['h']))
+                if quad['rotated']:
+                    tile = tile.transpose(Image.ROTATE_270)
+                image.paste(tile, tuple(quad['offset']))
+            source = Image.open("test-sprites/" + spr['name']).convert('RGBA')
+            self.assertEqual(image.getchannel('A').getbbox(), source.getchannel('A').getbbox())
+            self.assertEqual(image.tobytes(), Image.composite(source, image, source).tobytes())
+
+class MeshTest(unittest.TestCase):
+    def test_mesh_default(self):
+        texpack.main("test/test_mesh_default_", "test-sprites/house*", "--mesh")
+
+    def test_mesh_custom(self):
+        import json
+        texpack.main("test/test_mesh_custom_", "test-sprites/house*", "test-sprites/knt*",
+                     "--mask", "--mesh=16", "--mesh-vertices=6", "--rotate",
+                     "--mesh-cache=test/test_mesh_cache.json")
+        with open("test/test_mesh_custom_0.idx") as f:
+            index = json.load(f)
+        for spr in index['sprites']:
+            mesh = spr['mesh']
+            self.assertLessEqual(len(mesh['vertices']), 6)
+            self.assertEqual(len(mesh['uvs']), len(mesh['vertices']))
+            self.assertEqual(len(mesh['triangles']), len(mesh['vertices']) - 2)
+
+    def test_mesh_vertices(self):
+        from PIL import Image, ImageDraw
+        ## Reducing the hull of this shape would cross the image edge
+        image = Image.new('RGBA', (8, 11))
+        draw = ImageDraw.Draw(image)
+        draw.ellipse((3, 8, 5, 12), (255, 0, 0, 255))
+        draw.ellipse((2, 1, 6, 9), (255, 0, 0, 255))
+        outline = texpack.outline_image(image, 0, 4)
+        self.assertLessEqual(len(outline), 4)
+        self.assertTrue(all(0 <= x <= 8 and 0 <= y <= 11 for x, y in outline))
+        self.assertRaises(SystemExit, texpack.build_arg_parser().parse_args,
+                          ["test/test_mesh_", "test-sprites", "--mesh-vertices=3"])
+
 class ExtrudeTest(unittest.TestCase):
     def test_extrude_default(self):
         texpack.main("test/test_extrude_default_", "test-sprites", "--extrude")
@@ -52,6 +174,35 @@ class ExtrudeTest(unittest.TestCase):
     def test_extrude_custom(self):
         texpack.main("test/test_extrude_custom_", "test-sprites", "--extrude=4")
 
+class BleedTest(unittest.TestCase):
+    def test_bleed(self):
+        from PIL import Image
+        texpack.main("test/test_bleed_plain_", "test-sprites/[ak]*.gif", "--sort=name")
+        texpack.main("test/test_bleed_", "test-sprites/[ak]*.gif", "--sort=name", "--bleed=2")
+        plain = Image.open("test/test_bleed_plain_0.png")
+        image = Image.open("test/test_bleed_0.png")
+        self.assertEqual(image.getchannel('A').tobytes(), plain.getchannel('A').tobytes())
+        self.assertNotEqual(image.tobytes(), plain.tobytes())
+
+    def test_bleed_texture(self):
+        from PIL import Image
+        from spritesheet import bleed_texture
+        image = Image.new('RGBA', (16, 16), (255, 255, 255, 0))
+        image.paste((200, 10, 20, 255), (5, 5, 8, 8))
+        image = bleed_texture(image, 2)
+        row = [image.getpixel((x, 6))[:3] for x in range(16)]
+        self.assertEqual(row[3:10], [(200, 10, 20)] * 7)
+        self.assertEqual(row[2], (255, 255, 255))
+
+    def test_premultiply(self):
+        import json
+        from PIL import Image
+        texpack.main("test/test_premultiply_", "test-sprites/[ak]*.gif", "--bleed", "--premultiply")
+        image = Image.open("test/test_premultiply_0.png")
+        self.assertFalse(any(r or g or b for r, g, b, a in image.getdata() if not a))
+        with open("test/test_premultiply_0.idx") as f:
+            self.assertTrue(json.load(f)['premultiplied'])
+
 class PadTest(unittest.TestCase):
     def test_pad_default(self):
         texpack.main("test/test_pad_default_", "test-sprites", "--pad")
@@ -59,6 +210,13 @@ class PadTest(unittest.TestCase):
     def test_pad_custom(self):
         texpack.main("test/test_pad_custom_", "test-sprites", "--pad=4")
 
+class BorderTest(unittest.TestCase):
+    def test_border_default(self):
+        texpack.main("test/test_border_default_", "test-sprites", "--border")
+
+    def test_border_custom(self):
+        texpack.main("test/test_border_custom_", "test-sprites", "--border=4", "--pad=2", "--extrude=2")
+
 class SortTest(unittest.TestCase):
     def test_sort_default(self):
         with self.assertRaises(SystemExit): # "expected argument"
@@ -76,6 +234,29 @@ class SortTest(unittest.TestCase):
     def test_sort_name(self):
         texpack.main("test/test_sort_name_", "test-sprites", "--sort=name")
 
+class SeedTest(unittest.TestCase):
+    def read(self, prefix):
+        with open(prefix + "0.png", "rb") as f:
+            return f.read()
+
+    def test_sorted_sources(self):
+        files = list(texpack.find_sprite_files(["test-sprites"]))
+        self.assertEqual(files, sorted(files))
+
+    def test_reproducible(self):
+        args = ("test-sprites/[ak]*.gif", "--quantize", "--force")
+        texpack.main("test/test_seed_jobs1_", *(args + ("--jobs=1",)))
+        texpack.main("test/test_seed_jobs4_", *(args + ("--jobs=4",)))
+        self.assertEqual(self.read("test/test_seed_jobs1_"), self.read("test/test_seed_jobs4_"))
+
+    def test_seed(self):
+        args = ("test-sprites/[ak]*.gif", "--sort=random", "--force")
+        texpack.main("test/test_seed_a_", *(args + ("--seed=1",)))
+        texpack.main("test/test_seed_b_", *(args + ("--seed=1",)))
+        texpack.main("test/test_seed_c_", *(args + ("--seed=2",)))
+        self.assertEqual(self.read("test/test_seed_a_"), self.read("test/test_seed_b_"))
+        self.assertNotEqual(self.read("test/test_seed_a_"), self.read("test/test_seed_c_"))
+
 class LayoutTest(unittest.TestCase):
     def test_layout_default(self):
         with self.assertRaises(SystemExit): # "expected argument"
@@ -87,17 +268,132 @@ class LayoutTest(unittest.TestCase):
     def test_layout_stack(self):
         texpack.main("test/test_layout_stack_", "test-sprites", "--layout=stack")
 
+    def test_layout_shelf_rules(self):
+        for layout in ['shelf', 'stack']:
+            for rule in ['baf', 'nf', 'ff', 'bhf']:
+                texpack.main("test/test_layout_%s_%s_" % (layout, rule), "test-sprites/[ak]*.gif",
+                             "--layout=%s" % layout, "--layout-rule=%s" % rule, "--rotate")
+
     def test_layout_maxrects(self):
         texpack.main("test/test_layout_maxrects_", "test-sprites", "--layout=max-rects")
 
+    def test_layout_maxrects_rules(self):
+        for rule in ['bssf', 'blsf', 'baf', 'bl', 'cp']:
+            texpack.main("test/test_layout_maxrects_%s_" % rule, "test-sprites/[ak]*.gif",
+                         "--layout=max-rects", "--layout-rule=%s" % rule, "--rotate")
+
+    def test_layout_maxrects_online(self):
+        texpack.main("test/test_layout_maxrects_online_", "test-sprites",
+                     "--layout=max-rects", "--online")
+
+    def test_layout_guillotine(self):
+        texpack.main("test/test_layout_guillotine_", "test-sprites", "--layout=guillotine")
+
+    def test_layout_guillotine_rules(self):
+        for rule in ['baf', 'bssf', 'blsf']:
+            for split in ['slas', 'llas', 'sas', 'las', 'minas', 'maxas']:
+                texpack.main("test/test_layout_guillotine_%s_%s_" % (rule, split),
+                             "test-sprites/[ak]*.gif", "--layout=guillotine",
+                             "--layout-rule=%s" % rule, "--split-rule=%s" % split, "--rotate")
+
+    def test_layout_bitmap(self):
+        texpack.main("test/test_layout_bitmap_", "test-sprites", "--layout=bitmap",
+                     "--trim", "--pad", "--rotate")
+
+    def test_layout_bitmap_cell_size(self):
+        texpack.main("test/test_layout_bitmap_cell_size_", "test-sprites/[ak]*.gif",
+                     "--layout=bitmap", "--cell-size=4", "--extrude")
+
+    def test_layout_bitmap_pad(self):
+        import random
+        from PIL import Image, ImageChops, ImageDraw, ImageFilter
+        rng = random.Random(0)
+        sprites = []
+        for i in range(60):
+            w, h = rng.randint(8, 40), rng.randint(8, 40)
+            image = Image.new('RGBA', (w, h), (0, 0, 0, 0))
+            ImageDraw.Draw(image).ellipse((0, 0, w - 1, h - 1), (i * 4 + 4, 255, 255, 255))
+            sprites.append(('%02d' % i, image))
+        ## The red channel tells the sprites apart; pixels of different
+        ## sprites must be more than --pad=4 apart in both directions
+        for options in (['--cell-size=4'], ['--cell-size=3', '--extrude', '--rotate']):
+            sheets, _ = texpack.pack(sprites, ['--layout=bitmap', '--pad=4'] + options)
+            for sheet in sheets:
+                red = sheet.getchannel('R')
+                for i in range(60):
+                    own = red.point(lambda v: 255 if v == i * 4 + 4 else 0)
+                    near = own.filter(ImageFilter.MaxFilter(9))
+                    others = ImageChops.subtract(red.point(lambda v: 255 if v else 0), own)
+                    self.assertIsNone(ImageChops.multiply(near, others).getbbox(), (options, i))
+
+    def test_layout_rule_unsupported(self):
+        with self.assertRaises(ValueError):
+            texpack.main("test/test_layout_rule_unsupported_", "test-sprites",
+                         "--layout=shelf", "--layout-rule=bssf")
+
     @unittest.expectedFailure # remove when implemented
     def test_layout_skyline(self):
         texpack.main("test/test_layout_skyline_", "test-sprites", "--layout=skyline")
 
+class GroupTest(unittest.TestCase):
+    def sheets(self, *argv):
+        args = texpack.build_arg_parser().parse_args(("test/test_group_",) + argv)
+        return texpack.build_sprite_sheets(args, texpack.load_and_process_sprites(args))
+
+    def test_group_regex(self):
+        sheets = self.sheets("test-sprites/[a-m]*.gif", "--max-size=256", "--group=^([a-z]+\\d)_")
+        self.assertGreater(len(sheets), 1)
+        self.assertEqual(texpack.report_split_groups(sheets), {})
+
+    def test_group_dir(self):
+        texpack.main("test/test_group_dir_", "test-sprites", "--max-size=512", "--group=dir")
+
+    def test_group_manifest(self):
+        import glob
+        import json
+        if not os.path.isdir("test/sources"):
+            os.makedirs("test/sources")
+        entries = [{'path': os.path.relpath(f, "test/sources"), 'group': os.path.basename(f)[:4]}
+                   for f in sorted(glob.glob("test-sprites/[a-m]*.gif"))]
+        with open("test/sources/groups.json", 'w') as f:
+            json.dump({'sprites': entries}, f)
+        sheets = self.sheets("test/sources/groups.json", "--max-size=256")
+        self.assertGreater(len(sheets), 1)
+        self.assertEqual(texpack.report_split_groups(sheets), {})
+
+    def test_group_split(self):
+        sheets = self.sheets("test-sprites/[a-m]*.gif", "--max-size=256", "--group=^")
+        self.assertEqual(list(texpack.report_split_groups(sheets)), [''])
+
+    def test_group_no_overlap(self):
+        sheets = self.sheets("test-sprites", "--max-size=256", "--group=^(\\w)")
+        self.assertTrue(texpack.report_split_groups(sheets))
+        for sheet in sheets:
+            sheet.finish()
+            for i, a in enumerate(sheet.sprites):
+                for b in sheet.sprites[:i]:
+                    self.assertFalse(a.intersects(b), (a.name, b.name))
+
 class RotateTest(unittest.TestCase):
     def test_rotate(self):
         texpack.main("test/test_rotate_", "test-sprites", "--rotate")
 
+class OptimizeTest(unittest.TestCase):
+    def test_optimize(self):
+        texpack.main("test/test_optimize_", "test-sprites", "--optimize=2")
+
+    def test_optimize_rotate(self):
+        texpack.main("test/test_optimize_rotate_", "test-sprites", "--optimize=2", "--rotate", "--jobs=2")
+
+    def test_optimize_tries(self):
+        chosen = []
+        for jobs in ("--jobs=1", "--jobs=3"):
+            args = texpack.build_arg_parser().parse_args(
+                ["test/test_optimize_tries_", "test-sprites/[ak]*.gif", "--optimize-tries=6", jobs])
+            best = texpack.optimize_layout(args, texpack.load_and_process_sprites(args))
+            chosen.append((best.layout, best.layout_rule, best.sort, best.rotate))
+        self.assertEqual(chosen[0], chosen[1])
+
 class NpotTest(unittest.TestCase):
     def test_npot(self):
         texpack.main("test/test_npot_", "test-sprites", "--npot")
@@ -126,10 +422,262 @@ class ScaleTest(unittest.TestCase):
     def test_scale(self):
         texpack.main("test/test_scale_", "test-sprites", "--scale")
 
+class QuantizeTest(unittest.TestCase):
+    def test_quantize(self):
+        from PIL import Image
+        texpack.main("test/test_quantize_", "test-sprites/[ak]*.gif", "--quantize")
+        image = Image.open("test/test_quantize_0.png")
+        self.assertEqual(image.mode, 'P')
+        self.assertIn('transparency', image.info)
+
+    def test_quantize_shared_palette(self):
+        import glob
+        from PIL import Image
+        texpack.main("test/test_quantize_shared_", "test-sprites", "--max-size=512",
+                     "--quantize=octree", "--palette-depth=4", "--shared-palette",
+                     "--dither=diffusion")
+        palettes = set(tuple(Image.open(f).getpalette())
+                       for f in glob.glob("test/test_quantize_shared_*.png"))
+        self.assertEqual(len(palettes), 1)
+        self.assertLessEqual(len(palettes.pop()), 16 * 3)
+
+    def test_quantize_visible_pixels(self):
+        from PIL import Image
+        from spritesheet import Sprite
+        colors = [(0, 0, 255), (0, 255, 0), (255, 255, 0)]
+        image = Image.new('RGBA', (64, 64))
+        for i, color in enumerate(colors):
+            image.paste(color + (255,), (i * 8, 0, i * 8 + 8, 8))
+        texture = texpack.quantize_texture(image, 'median-cut', 'adaptive', 2, None)
+        palette = texture.getpalette()[:9]
+        self.assertEqual(sorted(zip(palette[0::3], palette[1::3], palette[2::3])), sorted(colors))
+        palette = texpack.build_palette([Sprite(image)], 'octree', 'adaptive', 2).getpalette()[:9]
+        self.assertEqual(sorted(zip(palette[0::3], palette[1::3], palette[2::3])), sorted(colors))
+
+    def test_quantize_sample(self):
+        from PIL import Image
+        from spritesheet import Sprite
+        sprites = [Sprite(Image.new('RGBA', (100, 50), (i, 0, 0, 255))) for i in range(100)]
+        mosaic, sampled = texpack.sample_sprites(sprites, count=30)
+        self.assertEqual(sampled, sprites[::4])
+        self.assertEqual(mosaic.size, (16 * 64, 2 * 64))
+
 class CompressTest(unittest.TestCase):
     def test_compress(self):
         texpack.main("test/test_compress_", "test-sprites", "--compress")
 
+class PngTest(unittest.TestCase):
+    def test_png_options(self):
+        texpack.main("test/test_png_options_", "test-sprites/[ak]*.gif",
+                     "--png-level=9", "--png-strategy=filtered", "--png-optimize")
+
+    def test_png_threads(self):
+        from PIL import Image
+        texpack.main("test/test_png_reference_", "test-sprites/[ak]*.gif")
+        reference = Image.open("test/test_png_reference_0.png").convert('RGBA')
+        for png_filter in ['none', 'sub', 'up']:
+            texpack.main("test/test_png_threads_", "test-sprites/[ak]*.gif",
+                         "--png-threads=2", "--png-filter=%s" % png_filter)
+            image = Image.open("test/test_png_threads_0.png")
+            self.assertEqual(image.convert('RGBA').tobytes(), reference.tobytes())
+
+    def test_png_fast(self):
+        texpack.main("test/test_png_fast_", "test-sprites", "--png-fast")
+
+class RawTest(unittest.TestCase):
+    def test_raw(self):
+        import json
+        from PIL import Image
+        texpack.main("test/test_raw_", "test-sprites/[ak]*.gif", "--format=raw", "--npot")
+        texpack.main("test/test_raw_png_", "test-sprites/[ak]*.gif", "--npot")
+        header, data = texpack.read_raw_texture("test/test_raw_0.raw")
+        with open("test/test_raw_0.idx") as f:
+            self.assertEqual([header['width'], header['height']], json.load(f)['size'])
+        self.assertEqual(header['format'], 'RGBA8')
+        self.assertEqual(header['offset'] % 64, 0)
+        image = Image.open("test/test_raw_png_0.png").convert('RGBA')
+        self.assertEqual(data.tobytes(), image.tobytes())
+
+    def test_raw_color_depth(self):
+        for depth in ['RGB4', 'RGBA4', 'RGB5', 'RGB565', 'RGBA5551', 'RGB8']:
+            texpack.main("test/test_raw_%s_" % depth, "test-sprites/[ak]*.gif",
+                         "--format=raw", "--npot", "--color-depth=%s" % depth)
+            header, data = texpack.read_raw_texture("test/test_raw_%s_0.raw" % depth)
+            self.assertEqual(header['format'], depth)
+            self.assertEqual(header['pitch'] % 4, 0)
+            self.assertEqual(len(data), header['pitch'] * header['height'])
+
+class ArrayTest(unittest.TestCase):
+    def test_array_raw(self):
+        import json
+        from PIL import Image
+        texpack.main("test/test_array_raw_", "test-sprites", "--max-size=512",
+                     "--array", "--format=raw")
+        texpack.main("test/test_array_png_", "test-sprites", "--max-size=512")
+        header, data = texpack.read_raw_texture("test/test_array_raw_array.raw")
+        with open("test/test_array_raw_array.idx") as f:
+            index = json.load(f)
+        self.assertGreater(header['layers'], 1)
+        self.assertEqual(index['layers'], header['layers'])
+        self.assertEqual(set(spr['layer'] for spr in index['sprites']),
+                         set(range(header['layers'])))
+        size = header['pitch'] * header['height']
+        for i in range(header['layers']):
+            image = Image.open("test/test_array_png_%d.png" % i).convert('RGBA')
+            layer = Image.frombytes('RGBA', (header['width'], header['height']),
+                                    data[i * size:(i + 1) * size].tobytes())
+            self.assertEqual(layer.crop((0, 0) + image.size).tobytes(), image.tobytes())
+
+    def test_array_dds(self):
+        texpack.main("test/test_array_dds_", "test-sprites", "--max-size=512",
+                     "--array", "--format=dds", "--color-depth=RGB565")
+
+    def test_array_format(self):
+        with self.assertRaises(ValueError):
+            texpack.main("test/test_array_format_", "test-sprites", "--array")
+
+class DigestTest(unittest.TestCase):
+    def test_unchanged_sheets(self):
+        args = ("test/test_digest_", "test-sprites/[ak]*.gif", "--max-size=256")
+        texpack.main(*args)
+        mtime = os.path.getmtime("test/test_digest_0.png")
+        os.utime("test/test_digest_0.png", (mtime - 100, mtime - 100))
+
+        texpack.main(*args)
+        self.assertEqual(os.path.getmtime("test/test_digest_0.png"), mtime - 100)
+
+        texpack.main(*(args + ("--force",)))
+        self.assertNotEqual(os.path.getmtime("test/test_digest_0.png"), mtime - 100)
+
+    def test_changed_options(self):
+        args = ("test/test_digest_options_", "test-sprites/[ak]*.gif")
+        texpack.main(*args)
+        with open("test/test_digest_options_0.digest") as f:
+            digest = f.read()
+
+        texpack.main(*(args + ("--premultiply",)))
+        with open("test/test_digest_options_0.digest") as f:
+            self.assertNotEqual(f.read(), digest)
+
+class PackTest(unittest.TestCase):
+    def test_pack(self):
+        import io
+        from PIL import Image
+        data = io.BytesIO()
+        Image.new('RGB', (5, 7), 'red').save(data, 'PNG')
+        sprites = [
+            ('image', Image.new('L', (12, 16), 255)),
+            ('copy', Image.new('L', (12, 16), 255)),
+            ('raw', ('RGBA', (4, 4), b'\xff' * 64)),
+            ('file', data.getvalue()),
+        ]
+        before = sorted(os.listdir('.'))
+        sheets, index = texpack.pack(sprites, ['--alias', '--npot'])
+        self.assertEqual(sorted(os.listdir('.')), before)
+        self.assertEqual(len(sheets), 1)
+        self.assertEqual(sheets[0].size, tuple(index[0]['size']))
+        entries = dict((entry['name'], entry) for entry in index[0]['sprites'])
+        self.assertEqual(sorted(entries), ['copy', 'file', 'image', 'raw'])
+        copy = dict(entries['copy'], name='image')
+        self.assertEqual(copy.pop('alias'), 'image')
+        self.assertEqual(copy, entries['image'])
+
+    def test_pack_inputs_unchanged(self):
+        from PIL import Image
+        image = Image.new('RGBA', (8, 8), (255, 255, 255, 255))
+        image.paste((255, 0, 0, 255), (2, 2, 6, 6))
+        data = image.tobytes()
+        texpack.pack([('a', image)], ['--mask', '--trim'])
+        self.assertEqual(image.tobytes(), data)
+
+    def test_pack_options(self):
+        self.assertRaises(ValueError, texpack.pack, [], ['--layout=nope'])
+        self.assertRaises(ValueError, texpack.pack, [])
+
+class ProfileTest(unittest.TestCase):
+    def test_profile_json(self):
+        import json
+        ## The second build reuses the unchanged sheets
+        texpack.main("test/test_profile_json_", "test-sprites")
+        texpack.main("test/test_profile_json_", "test-sprites", "--profile=test/test_profile.json")
+        with open("test/test_profile.json") as f:
+            stages = dict((r['stage'], r) for r in json.load(f)['stages'])
+        self.assertIn('load sprites', stages)
+        self.assertIn('passes', stages['layout sheet 0'])
+
+    def test_profile_quantize(self):
+        import glob
+        import json
+        for f in glob.glob("test/test_profile_quantize_*.digest"):
+            os.remove(f)
+        texpack.main("test/test_profile_quantize_", "test-sprites/[ak]*.gif", "--quantize",
+                     "--profile=test/test_profile_quantize.json")
+        with open("test/test_profile_quantize.json") as f:
+            stages = [r['stage'] for r in json.load(f)['stages']]
+        self.assertIn('quantize texture', stages)
+
+    def test_profile_csv(self):
+        texpack.main("test/test_profile_csv_", "test-sprites", "--profile=test/test_profile.csv")
+
+    def test_profile_layout(self):
+        texpack.main("test/test_profile_layout_", "test-sprites", "--profile-layout=test/test_profile.prof")
+
+class CacheTest(unittest.TestCase):
+    def test_cache(self):
+        parser = texpack.build_arg_parser()
+        args = parser.parse_args(["test/test_cache_", "test-sprites", "--trim"])
+        cache = texpack.SpriteCache()
+        texpack.run(args, cache)
+        self.assertTrue(cache.entries)
+        sprites = texpack.load_sprites(args.sprites, cache, (args.mask, args.trim))
+        self.assertTrue(all(hasattr(spr, 'cached') for spr in sprites))
+
+    def test_cache_limit(self):
+        from PIL import Image
+        image = Image.new('RGBA', (16, 16))
+        cache = texpack.SpriteCache(max_bytes=3 * 16 * 16 * 4)
+        files = sorted(texpack.find_sprite_files(["test-sprites/[ak]*.gif"]))[:4]
+        for f in files[:3]:
+            cache.put(f, None, image)
+        self.assertIsNotNone(cache.get(files[0]))
+        cache.put(files[3], None, image)
+        self.assertEqual(len(cache.entries), 3)
+        self.assertIsNone(cache.get(files[1]))
+        self.assertIsNotNone(cache.get(files[0]))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+class LazyTest(unittest.TestCase):
+    def test_lazy(self):
+        sprites = texpack.load_sprites(["test-sprites/*.gif"])
+        self.assertFalse(any(spr.loaded for spr in sprites))
+        spr = sprites[0]
+        self.assertEqual(spr.image.size, spr.image_size)
+        self.assertTrue(spr.loaded)
+        spr.release()
+        self.assertFalse(spr.loaded)
+        texpack.trim_sprites([spr])
+        spr.release()
+        self.assertTrue(spr.loaded)
+
+class ServeTest(unittest.TestCase):
+    def test_serve(self):
+        import io
+        import json
+        jobs = io.StringIO(
+            '["test/test_serve_a_", "test-sprites/*.gif"]\n'
+            '{"id": "b", "args": ["test/test_serve_b_", "test-sprites/*.gif", "--trim"]}\n'
+            '{"id": "c", "args": ["test/test_serve_c_"]}\n'
+        )
+        results = io.StringIO()
+        server = texpack.JobServer(2)
+        try:
+            server.handle(jobs, results)
+        finally:
+            server.close()
+        status = dict((r['id'], r['status']) for r in
+                      map(json.loads, results.getvalue().splitlines()))
+        self.assertEqual(status, {0: 'ok', 'b': 'ok', 'c': 'error'})
+
 ################################################################################
 
 if __name__ == '__main__':
@@ -16,21 +16,23 @@
 import logging
 log = logging.getLogger(__name__)
 
-logging.basicConfig(level=logging.INFO)
-
 import math
 import os
 
 from PIL import Image
 from PIL import ImageChops
 from PIL import ImageColor
+from PIL import ImageSequence
 
 from layouts import get_layout
-from spritesheet import Sprite, Sheet
+from spritesheet import Rect, Sprite, Sheet
 
 ################################################################################
 
 import datetime
+import sys
+import threading
+import time
 
 def strfdelta(dt, fmt=None):
     dy = dt.days
@@ -63,52 +65,367 @@ def strfdelta(dt, fmt=None):
         .replace('%F', '%03d' % ms)
     )
 
+def get_peak_rss():
+    """
+    Return the peak resident set size of this process in bytes, or None if it
+    cannot be determined on this platform.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    ## Linux reports kilobytes, macOS reports bytes
+    if sys.platform != 'darwin':
+        peak *= 1024
+
+    return peak
+
+class Profile(object):
+    """
+    Collects a record for every Timer that finishes on this thread while the
+    profile is active, and writes them as JSON or CSV for aggregation.
+
+    Callers can attach counts to a record through Timer.counts, e.g. the number
+    of sprites or sheets a stage processed.
+    """
+
+    _local = threading.local()
+
+    FIELDS = ['stage', 'wall', 'cpu', 'peak_rss', 'sprites', 'sheets', 'passes']
+
+    def __init__(self):
+        self.records = []
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = Profile.current()
+        Profile._local.current = self
+        return self
+
+    def __exit__(self, *exc_info):
+        Profile._local.current = self.previous
+
+    @staticmethod
+    def current():
+        return getattr(Profile._local, 'current', None)
+
+    def add(self, record):
+        self.records.append(record)
+
+    def save(self, filename):
+        import json
+
+        with open(filename, 'w') as f:
+            if filename.lower().endswith('.csv'):
+                import csv
+                writer = csv.DictWriter(f, self.FIELDS, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(self.records)
+            else:
+                json.dump({'stages': self.records}, f, indent=2)
+
 class Timer(object):
-    def __init__(self, name='Timer', callback=None):
+    """
+    Logs the time taken by a block, and records it in `profile`, or else in
+    the current thread's profile; worker threads have none of their own.
+    """
+
+    def __init__(self, name='Timer', callback=None, profile=None):
         self.name = name
         self.callback = callback
+        self.profile = profile
         self.start = None
         self.finish = None
+        self.counts = {}
 
     def __enter__(self):
         self.start = datetime.datetime.now()
+        self.cpu_start = time.process_time()
         log.debug("%s: start: %s", self.name, self.start.strftime('%H:%M:%S'))
         return self
 
     def __exit__(self, *exc_info):
         self.finish = datetime.datetime.now()
+        cpu = time.process_time() - self.cpu_start
         dt = self.finish - self.start
         log.debug("%s: end: %s", self.name, self.finish.strftime('%H:%M:%S'))
         log.debug("%s: duration: %s", self.name, strfdelta(dt))
+
+        profile = self.profile or Profile.current()
+        if profile is not None:
+            record = dict(self.counts)
+            record.update({
+                'stage': self.name,
+                'wall': dt.total_seconds(),
+                'cpu': cpu,
+                'peak_rss': get_peak_rss(),
+            })
+            profile.add(record)
+
         if self.callback is not None:
             self.callback(dt)
 
 ################################################################################
 
-def load_sprites(filenames):
+class SpriteCache(object):
+    """
+    Keeps loaded and processed sprite images in memory between builds.  Entries
+    are keyed by filename and processing options, and are discarded when the
+    file's size or modification time changes.
+
+    If keep_decoded is set, freshly decoded images are also kept under a key of
+    None, so builds with different processing options can share them.
+
+    If max_bytes is set, the least recently used images are discarded to keep
+    the pixel data held below that size.
+    """
+
+    def __init__(self, keep_decoded=False, max_bytes=None):
+        from collections import OrderedDict
+        self.entries = OrderedDict()
+        self.keep_decoded = keep_decoded
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def stamp(filename):
+        st = os.stat(filename)
+        return st.st_mtime, st.st_size
+
+    @staticmethod
+    def image_bytes(image):
+        w, h = image.size
+        return w * h * len(image.getbands())
+
+    def discard(self, entry):
+        _, image = self.entries.pop(entry)
+        self.size -= self.image_bytes(image)
+
+    def get(self, filename, key=None):
+        with self.lock:
+            entry = self.entries.get((filename, key))
+
+            if entry is not None:
+                try:
+                    if entry[0] == self.stamp(filename):
+                        self.entries.move_to_end((filename, key))
+                        return entry[1]
+                except OSError:
+                    pass
+
+                self.discard((filename, key))
+
+        return None
+
+    def put(self, filename, key, image):
+        with self.lock:
+            try:
+                stamp = self.stamp(filename)
+            except OSError:
+                return
+
+            if (filename, key) in self.entries:
+                self.discard((filename, key))
+
+            self.entries[(filename, key)] = stamp, image
+            self.size += self.image_bytes(image)
+
+            if self.max_bytes is not None:
+                while self.entries and self.size > self.max_bytes:
+                    self.discard(next(iter(self.entries)))
+
+    def prune(self, filenames):
+        with self.lock:
+            for filename, key in list(self.entries):
+                if filename not in filenames:
+                    self.discard((filename, key))
+
+################################################################################
+
+def find_sprite_files(filenames):
     from glob import glob
 
+    ## Matches and directory entries are sorted so that the sprite order, and
+    ## so the layout, does not depend on the file system
+    for fn in filenames:
+        for f in sorted(glob(fn)):
+            f = os.path.abspath(f)
+            if os.path.isdir(f):
+                for root, dirs, files in os.walk(f):
+                    dirs.sort()
+                    for ff in sorted(files):
+                        yield os.path.join(root, ff)
+
+            else:
+                yield f
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+def read_archive(filename):
+    """
+    Yield (name, data) for each file in a zip or tar archive, reading the
+    archive front to back in one pass.
+    """
+    import tarfile
+    import zipfile
+
+    try:
+        if zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as archive:
+                members = [info for info in archive.infolist() if not info.filename.endswith('/')]
+                for info in sorted(members, key=lambda info: info.header_offset):
+                    yield info.filename, archive.read(info)
+
+        else:
+            with tarfile.open(filename, 'r|*') as archive:
+                for info in archive:
+                    if info.isfile():
+                        yield info.name, archive.extractfile(info).read()
+
+    except (zipfile.BadZipfile, tarfile.TarError) as e:
+        log.warning('Warning: cannot read archive %s: %s', filename, e)
+
+def read_manifest(filename):
+    """
+    Return a list of entries for the sprites listed in a JSON manifest, or an
+    empty list if the file is not a manifest.  A manifest is an object whose
+    `sprites` list has a path relative to the manifest for each sprite, or an
+    object with the `path` and optionally the image `size` and content
+    `digest` (see `Sprite.digest`) to avoid reading the file, and a `group`
+    of sprites to keep on one sheet.
+    """
+    import json
+
+    try:
+        with open(filename) as f:
+            entries = json.load(f)['sprites']
+    except (IOError, ValueError, KeyError, TypeError):
+        return []
+
+    root = os.path.dirname(filename)
     r = []
 
-    with Timer('load sprites'):
-        for fn in filenames:
-            for f in glob(fn):
-                f = os.path.abspath(f)
-                if os.path.isdir(f):
-                    for root, _, files in os.walk(f):
-                        for ff in files:
-                            try:
-                                r.append(Sprite(os.path.join(root, ff)))
-                            except IOError:
-                                ## Not an image file?
-                                pass
-
-                else:
-                    try:
-                        r.append(Sprite(f))
-                    except IOError:
-                        ## Not an image file?
-                        pass
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {'path': entry}
+
+        entry = dict(entry, path=os.path.join(root, entry['path']))
+        r.append(entry)
+
+    return r
+
+def find_sprite_sources(filenames):
+    """
+    Yield (source, info) for each sprite file, where `source` is a filename,
+    or a file object for a file read from an archive, and `info` is a dict
+    with its `path` and `name`, and any other entries from a manifest.
+    """
+    import io
+
+    for f in find_sprite_files(filenames):
+        if f.lower().endswith(ARCHIVE_EXTENSIONS):
+            for member, data in read_archive(f):
+                yield io.BytesIO(data), {'path': os.path.join(f, member),
+                                         'name': os.path.basename(member)}
+
+        elif f.lower().endswith('.json'):
+            for entry in read_manifest(f):
+                yield entry['path'], dict(entry, name=os.path.basename(entry['path']))
+
+        else:
+            yield f, {'path': f, 'name': os.path.basename(f)}
+
+def load_frames(filename, frames=True, strip=None, name=None):
+    """
+    Return a sprite for each frame of an animated image if `frames` is set,
+    and/or for each `strip` sized (w, h) cell of its frames.  Frames are
+    decoded once into a shared buffer that the sprites crop their regions from.
+    Returns None when there is only one frame to load.
+    """
+    image = Image.open(filename)
+    count = getattr(image, 'n_frames', 1) if frames else 1
+    w, h = image.size
+    fw, fh = strip or (w, h)
+
+    if count == 1 and (fw, fh) == (w, h):
+        return None
+
+    if count == 1:
+        buffer = image.convert('RGBA')
+    else:
+        ## Stack frames vertically
+        buffer = Image.new('RGBA', (w, h * count))
+        for i, frame in enumerate(ImageSequence.Iterator(image)):
+            buffer.paste(frame.convert('RGBA'), (0, h * i))
+
+    name = name or os.path.basename(filename)
+    sprites = []
+
+    for i in range(count):
+        for y in range(0, h - fh + 1, fh):
+            for x in range(0, w - fw + 1, fw):
+                box = x, h * i + y, x + fw, h * i + y + fh
+                sprites.append(Sprite(buffer, name='%s#%d' % (name, len(sprites)), box=box))
+
+    return sprites
+
+def load_sprites(filenames, cache=None, key=None, frames=False, strip=None):
+    r = []
+
+    with Timer('load sprites') as timer:
+        for f, info in find_sprite_sources(filenames):
+            name = info['name']
+            image = None
+            loaded = []
+
+            if frames or strip:
+                try:
+                    loaded = load_frames(f, frames, strip, name) or []
+                except IOError:
+                    continue
+
+            ## Only files on disk are cached
+            file_cache = cache if str(f) == f else None
+
+            if not loaded and file_cache is not None:
+                image = file_cache.get(f, key)
+
+                if image is not None:
+                    spr = Sprite(image, name=name)
+                    spr.filename = f
+                    spr.cached = True
+                    loaded = [spr]
+
+            if not loaded and file_cache is not None and file_cache.keep_decoded:
+                image = file_cache.get(f)
+
+            if not loaded:
+                try:
+                    if image is None:
+                        spr = Sprite(f, name=name, size=info.get('size'), digest=info.get('digest'))
+                        if file_cache is not None and file_cache.keep_decoded:
+                            ## Processing may modify the image in place
+                            file_cache.put(f, None, spr.image.copy())
+                    else:
+                        spr = Sprite(image.copy(), name=name)
+                        spr.filename = f
+
+                    loaded = [spr]
+                except IOError:
+                    ## Not an image file?
+                    pass
+
+            for spr in loaded:
+                spr.path = info['path']
+                spr.group = info.get('group')
+
+            r.extend(loaded)
+
+        timer.counts['sprites'] = len(r)
 
     return r
 
@@ -167,7 +484,9 @@ def mask_sprites(sprites, color):
         color = ImageColor.getrgb(color)
         mask_func = lambda A,B,C,D: color
 
-    with Timer('mask sprites'):
+    with Timer('mask sprites') as timer:
+        timer.counts['sprites'] = len(sprites)
+
         for spr in sprites:
             w, h = spr.image.size
 
@@ -190,14 +509,18 @@ def mask_sprites(sprites, color):
             tband = ImageChops.lighter(
                 ImageChops.lighter(outbands[0], outbands[1]),
                 outbands[2]).convert('1')
-            spr.image.putalpha(tband)
+            image = spr.image
+            image.putalpha(tband)
+            spr.image = image
 
     return sprites
 
 ################################################################################
 
 def trim_sprites(sprites):
-    with Timer('trim sprites'):
+    with Timer('trim sprites') as timer:
+        timer.counts['sprites'] = len(sprites)
+
         for spr in sprites:
             box = spr.image.getbbox()
             spr.image = spr.image.crop(box)
@@ -206,18 +529,166 @@ def trim_sprites(sprites):
 
 ################################################################################
 
-def hash_sprites(sprites):
+def _cross(o, a, b):
+    return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
+
+def convex_hull(points):
+    """
+    Return the convex hull of `points` using Andrew's monotone chain.
+    """
+    points = sorted(set(points))
+
+    if len(points) <= 2:
+        return points
+
+    lower = []
+    for p in points:
+        while len(lower) >= 2 and _cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+
+    upper = []
+    for p in reversed(points):
+        while len(upper) >= 2 and _cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+
+    return lower[:-1] + upper[:-1]
+
+def _extend_edges(a, b, c, d):
+    ## Intersection of the rays a->b and d->c beyond b and c, if any
+    rx, ry = b[0]-a[0], b[1]-a[1]
+    sx, sy = c[0]-d[0], c[1]-d[1]
+    den = rx*sy - ry*sx
+
+    if den == 0:
+        return None
+
+    qx, qy = d[0]-a[0], d[1]-a[1]
+    t = float(qx*sy - qy*sx) / den
+    u = float(qx*ry - qy*rx) / den
+
+    if t < 1 or u < 1:
+        return None
+
+    return a[0] + t*rx, a[1] + t*ry
+
+def reduce_hull(hull, max_vertices, w, h):
+    """
+    Reduce a convex hull to at most `max_vertices` vertices by repeatedly
+    removing the edge whose neighbours can be extended to meet while adding the
+    least area.  The result still contains the original hull and stays within
+    the w x h image.  If no edge can be removed that way, the bounding box of
+    the hull is used instead, so `max_vertices` must be at least 4.
+    """
+    hull = list(hull)
+
+    while len(hull) > max_vertices:
+        best = None
+        n = len(hull)
+
+        for i in range(n):
+            a, b = hull[i-1], hull[i]
+            c, d = hull[(i+1) % n], hull[(i+2) % n]
+
+            p = _extend_edges(a, b, c, d)
+
+            if p is None or not (0 <= p[0] <= w and 0 <= p[1] <= h):
+                continue
+
+            added = abs(_cross(b, p, c)) / 2.0
+
+            if best is None or added < best[0]:
+                best = added, i, p
+
+        if best is None:
+            xs = [x for x, _ in hull]
+            ys = [y for _, y in hull]
+            x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+            return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+
+        _, i, p = best
+        hull[i] = p
+        del hull[(i+1) % n]
+
+    return hull
+
+def outline_image(image, threshold=0, max_vertices=8):
+    """
+    Return a convex outline, as a list of (x, y) pixel-corner coordinates, that
+    encloses every pixel of `image` with alpha above `threshold`; or None if
+    there are no such pixels.
+    """
+    w, h = image.size
+    mask = image.getchannel('A').point(lambda a: 255 if a > threshold else 0)
+
+    box = mask.getbbox()
+    if box is None:
+        return None
+
+    points = []
+
+    for y in range(box[1], box[3]):
+        row = mask.crop((box[0], y, box[2], y+1)).getbbox()
+        if row is not None:
+            x0, x1 = box[0] + row[0], box[0] + row[2]
+            points.extend([(x0, y), (x1, y), (x0, y+1), (x1, y+1)])
+
+    hull = convex_hull(points)
+
+    if max_vertices and len(hull) > max_vertices:
+        hull = reduce_hull(hull, max_vertices, w, h)
+
+    return [(round(x, 2), round(y, 2)) for x, y in hull]
+
+def mesh_sprites(sprites, threshold=0, max_vertices=8, cache=None):
+    """
+    Store a convex outline of each sprite's visible pixels as `spr.outline`.
+    Outlines are looked up in, and added to, `cache` by sprite content digest.
+    """
+    if cache is None:
+        cache = {}
+
+    with Timer('mesh sprites') as timer:
+        timer.counts['sprites'] = len(sprites)
+
+        for spr in sprites:
+            key = '%s:%d:%d' % (spr.digest, threshold, max_vertices)
+
+            if key not in cache:
+                cache[key] = outline_image(spr.image, threshold, max_vertices)
+
+            spr.outline = cache[key]
+
     return sprites
 
+def load_mesh_cache(filename):
+    import json
+
+    try:
+        with open(filename) as f:
+            return dict((key, [tuple(p) for p in outline] if outline else outline)
+                        for key, outline in json.load(f).items())
+    except (IOError, ValueError):
+        return {}
+
+def save_mesh_cache(filename, cache):
+    import json
+
+    with open(filename, 'w') as f:
+        json.dump(cache, f)
+
 ################################################################################
 
 def alias_sprites(sprites, tolerance=0):
     aliased = []
 
-    with Timer('alias sprites'):
+    with Timer('alias sprites') as timer:
+        timer.counts['sprites'] = len(sprites)
+
         if tolerance > 0:
             def is_alias(spr1, spr2):
-                if spr1.image.size != spr2.image.size:
+                if spr1.image_size != spr2.image_size:
                     return False
 
                 area = spr1.image.size[0] * spr1.image.size[1]
@@ -229,7 +700,7 @@ def alias_sprites(sprites, tolerance=0):
 
         else:
             def is_alias(spr1, spr2):
-                if spr1.image.size != spr2.image.size:
+                if spr1.image_size != spr2.image_size:
                     return False
                 diff = ImageChops.difference(spr1.image, spr2.image)
                 for mn, mx in diff.getextrema():
@@ -248,57 +719,101 @@ def alias_sprites(sprites, tolerance=0):
                     spr2.alias = spr1
                     aliased.append(spr2)
 
+                    if not hasattr(spr1, 'aliases'):
+                        spr1.aliases = []
+                    spr1.aliases.insert(0, spr2)
+
     return sprites, aliased
 
 ################################################################################
 
-def extrude_sprites(sprites, size):
-    if size:
-        with Timer('extrude sprites'):
-            for spr in sprites:
-                w, h = spr.image.size
-                image = Image.new(spr.image.mode, (w+size*2, h+size*2), (0,0,0,0))
-
-                A = spr.image.crop((0,  0,  1,1)).resize((size,size))
-                B = spr.image.crop((0,  0,  w,1)).resize((w,   size))
-                C = spr.image.crop((w-1,0,  w,1)).resize((size,size))
-                D = spr.image.crop((0,  0,  1,h)).resize((size,h   ))
-                E = spr.image.crop((w-1,0,  w,h)).resize((size,h   ))
-                F = spr.image.crop((0,  h-1,1,h)).resize((size,size))
-                G = spr.image.crop((0,  h-1,w,h)).resize((w,   size))
-                H = spr.image.crop((w-1,h-1,w,h)).resize((size,size))
-
-                image.paste(A, (0,     0     ), A)
-                image.paste(B, (size,  0     ), B)
-                image.paste(C, (size+w,0     ), C)
-                image.paste(D, (0,     size  ), D)
-                image.paste(E, (size+w,size  ), E)
-                image.paste(F, (0,     size+h), F)
-                image.paste(G, (size,  size+h), G)
-                image.paste(H, (size+w,size+h), H)
-                image.paste(spr.image, (size,size), spr.image)
-
-                spr.image = image
+def tile_sprites(sprites, size):
+    """
+    Split sprites into tiles of up to `size` pixels square, and return one
+    sprite per distinct tile.  Fully transparent tiles are dropped.  Each tile
+    has a `quads` list of the (sprite, x, y) places it is drawn at.
+    """
+    if size < 1:
+        raise ValueError('tile size must be positive, not %r' % size)
 
-    return sprites
+    tiles = []
+    digests = {}
+
+    with Timer('tile sprites') as timer:
+        timer.counts['sprites'] = len(sprites)
+
+        for spr in sprites:
+            w, h = spr.image.size
+
+            for y in range(0, h, size):
+                for x in range(0, w, size):
+                    image = spr.image.crop((x, y, min(x + size, w), min(y + size, h)))
+
+                    if image.getchannel('A').getbbox() is None:
+                        continue
+
+                    tile = Sprite(image, name='tile%d' % len(tiles))
+
+                    if tile.digest in digests:
+                        tile = digests[tile.digest]
+                    else:
+                        digests[tile.digest] = tile
+                        tiles.append(tile)
+                        tile.quads = []
+
+                    tile.quads.append((spr, x, y))
+
+            spr.release()
+
+        timer.counts['tiles'] = len(tiles)
+
+    log.info('%d sprites share %d tiles', len(sprites), len(tiles))
+
+    return tiles
 
 ################################################################################
 
-def pad_sprites(sprites, size):
-    if size:
-        with Timer('pad sprites'):
-            for spr in sprites:
-                w, h = spr.image.size
-                image = Image.new(spr.image.mode, (w+size, h+size), (0,0,0,0))
-                image.paste(spr.image, (0, 0), spr.image)
-                spr.image = image
+def group_sprites(sprites, key):
+    """
+    Set the group of sprites to keep on one sheet: the directory of each
+    sprite's file if `key` is `dir', or else the first group (or the whole
+    match) of the regular expression `key` in its name.  Sprites already in a
+    group from a manifest keep it, and sprites that do not match stay out of
+    any group.
+    """
+    import re
+
+    if key != 'dir':
+        pattern = re.compile(key)
+
+    for spr in sprites:
+        if getattr(spr, 'group', None) is not None:
+            continue
+
+        if key == 'dir':
+            spr.group = os.path.dirname(spr.path)
+        else:
+            match = pattern.search(spr.name)
+            if match:
+                spr.group = match.group(1) if pattern.groups else match.group(0)
 
     return sprites
 
 ################################################################################
 
-def sort_sprites(sprites, attr, rotate=False):
-    with Timer('sort sprites'):
+def sort_sprites(sprites, attr, rotate=False, seed=0):
+    """
+    Sort sprites in place by `attr`.  The sort is stable, so sprites that tie
+    keep their load order.  The `random` order is shuffled from `seed`.
+    """
+    with Timer('sort sprites') as timer:
+        timer.counts['sprites'] = len(sprites)
+
+        if attr == 'random':
+            import random
+            random.Random(seed).shuffle(sprites)
+            return sprites
+
         def key_width(s):
             return s.width
 
@@ -370,51 +885,583 @@ HALFTONE = [
 VOID_CLUSTER = [
 ]
 
-def quantize_texture(texture, quantize, palette_type, palette_depth, dither):
+QUANTIZE_METHODS = {
+    'median-cut': 0, ## Image.MEDIANCUT
+    'octree': 2,     ## Image.FASTOCTREE
+}
+
+def make_palette(colors):
+    """
+    Return a 'P' image with the palette `colors` (a flat list of RGB values)
+    and a last entry for transparent pixels, to quantize textures against.
+    The transparent entry repeats the first color, so that opaque pixels, which
+    take the first of equally near entries, never map to it.
+    """
+    image = Image.new('P', (1, 1))
+    image.putpalette(list(colors) + list(colors[:3]))
+    return image
+
+def web_safe_palette():
+    return make_palette([0x33 * c for r in range(6) for g in range(6) for b in range(6)
+                         for c in (r, g, b)])
+
+def visible_pixels(image):
+    """
+    Return an RGB image one pixel high of the pixels of an RGBA `image` with
+    alpha above zero, in no particular order, to build a palette from; or None
+    if there are none.
+    """
+    w, h = image.size
+    colors = image.getcolors(w * h)
+    data = b''.join(bytes(color[:3]) * count for count, color in colors if color[3])
+
+    if not data:
+        return None
+
+    return Image.frombytes('RGB', (len(data) // 3, 1), data)
+
+def adaptive_palette(image, quantize, colors):
+    """
+    Return a palette image of at most `colors` entries, the last transparent,
+    for the visible pixels of an RGBA `image`.
+    """
+    visible = visible_pixels(image)
+
+    if visible is None:
+        return make_palette([0, 0, 0])
+
+    palette = visible.quantize(max(1, colors - 1), QUANTIZE_METHODS[quantize])
+    return make_palette(palette.getpalette()[:3 * max(1, colors - 1)])
+
+def sample_sprites(sprites, size=64, columns=16, count=1024):
+    """
+    Return an RGBA mosaic of up to `count` of `sprites`, evenly spaced in the
+    list, each scaled down to at most `size` pixels square, to build a palette
+    from, and the list of the sprites sampled.
+    """
+    step = max(1, -(-len(sprites) // count))
+    sprites = sprites[::step]
+
+    rows = -(-len(sprites) // columns)
+    mosaic = Image.new('RGBA', (size * min(columns, len(sprites)), size * rows))
+
+    for i, spr in enumerate(sprites):
+        image = spr.image
+        w, h = image.size
+        scale = max(w, h) / float(size)
+
+        if scale > 1:
+            image = image.resize((max(1, int(w / scale)), max(1, int(h / scale))), Image.NEAREST)
+
+        mosaic.paste(image, (i % columns * size, i // columns * size))
+
+    return mosaic, sprites
+
+def build_palette(sprites, quantize, palette_type, palette_depth):
+    """
+    Return one palette image for all `sprites`, from a sample of their pixels,
+    for `quantize_texture` to share between sheets.
+    """
     colors = 2**int(palette_depth)
 
-    if quantize == 'median-cut':
-        method = 0
-    elif quantize == 'octree':
-        method = 2
-    else:
+    if palette_type == 'web-safe':
+        return web_safe_palette()
+
+    with Timer('build palette') as timer:
+        sample, sampled = sample_sprites(sprites)
+        timer.counts['sprites'] = len(sampled)
+
+        for spr in sampled:
+            spr.release()
+
+        return adaptive_palette(sample, quantize, colors)
+
+def quantize_texture(texture, quantize, palette_type, palette_depth, dither, palette=None,
+                     profile=None):
+    """
+    Return `texture` as an indexed image with at most 2**`palette_depth`
+    colors, mapped to `palette` if given, or else to a palette of its own.  The
+    last palette entry is transparent, and used for pixels under half alpha.
+    The time taken is recorded in `profile`, if given.
+    """
+    colors = 2**int(palette_depth)
+
+    if quantize not in QUANTIZE_METHODS:
         ## unsupported method
         return texture
 
-    with Timer('quantize texture'):
-        if palette_type == 'web-safe':
-            colors = 216
-            palette = ''.join([
-                '%c%c%c' % (0x33*r, 0x33*g, 0x33*b)
-                for r in xrange(6)
-                    for g in xrange(6)
-                        for b in xrange(6)
-                ])
+    with Timer('quantize texture', profile=profile):
+        rgb = texture.convert('RGB')
+        alpha = texture.getchannel('A')
+
+        if palette is None and palette_type == 'web-safe':
+            palette = web_safe_palette()
+
+        elif palette is None:
+            palette = adaptive_palette(texture, quantize, colors)
+
+        ## Pillow finds the nearest palette entries through its own color cube
+        ## cache, so no per-pixel search happens here
+        texture = rgb.quantize(palette=palette, dither=1 if dither == 'diffusion' else 0)
+
+        transparent = len(palette.getpalette()) // 3 - 1
+        texture.paste(transparent, mask=alpha.point(lambda a: 255 if a < 128 else 0))
+        texture.info['transparency'] = transparent
 
+    return texture
+
+################################################################################
+
+PNG_COLOR_TYPES = {'L': 0, 'RGB': 2, 'LA': 4, 'RGBA': 6}
+
+PNG_FILTERS = {'none': 0, 'sub': 1, 'up': 2}
+
+PNG_STRATEGIES = ['default', 'filtered', 'huffman', 'rle', 'fixed']
+
+def _png_strategy(name):
+    import zlib
+
+    return {
+        'default': zlib.Z_DEFAULT_STRATEGY,
+        'filtered': zlib.Z_FILTERED,
+        'huffman': zlib.Z_HUFFMAN_ONLY,
+        'rle': zlib.Z_RLE,
+        'fixed': zlib.Z_FIXED,
+    }[name]
+
+def _png_chunk(tag, data):
+    import struct
+    import zlib
+
+    return struct.pack('>I', len(data)) + tag + data + \
+        struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+def write_png(image, filename, level=6, strategy='default', filter_type='up', threads=None):
+    """
+    Write an L, LA, RGB or RGBA image as a PNG, deflating blocks of rows on up
+    to `threads` threads (by default, several per CPU).  As in pigz, each block
+    is compressed on its own with the end of the block before it as a preset
+    dictionary, and the raw deflate streams are joined with sync flushes into
+    one zlib stream.  Every row uses the same `filter_type`.
+    """
+    import struct
+    import zlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    w, h = image.size
+    bpp = len(image.getbands())
+    stride = w * bpp
+
+    ## Filter the whole image at once; bytes wrap around as PNG filters do
+    if filter_type != 'none':
+        prior = Image.new(image.mode, image.size)
+        if filter_type == 'up':
+            prior.paste(image.crop((0, 0, w, h - 1)), (0, 1))
         else:
-            palette = [0,0,0]*colors
-            ## TODO: generate palette
+            prior.paste(image.crop((0, 0, w - 1, h)), (1, 0))
+        image = ImageChops.subtract_modulo(image, prior)
+
+    data = image.tobytes()
+    tag = bytearray([PNG_FILTERS[filter_type]])
+    rows = max(1, (1 << 20) // (stride + 1))
+
+    blocks = [b''.join(tag + data[y * stride:(y + 1) * stride]
+                       for y in range(top, min(top + rows, h)))
+              for top in range(0, h, rows)]
+
+    level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+    strategy = _png_strategy(strategy)
+
+    def deflate(i):
+        options = {}
+        if i > 0:
+            options['zdict'] = blocks[i - 1][-32768:]
+
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy, **options)
+        out = compressor.compress(blocks[i])
+
+        if i + 1 < len(blocks):
+            return out + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return out + compressor.flush()
+
+    with Timer('deflate texture') as timer:
+        timer.counts['blocks'] = len(blocks)
+
+        with ThreadPoolExecutor(threads) as pool:
+            deflated = list(pool.map(deflate, range(len(blocks))))
+
+    adler = 1
+    for block in blocks:
+        adler = zlib.adler32(block, adler)
+
+    ## zlib header: 32K window, compression level hint, check bits
+    cmf = 0x78
+    flg = (2 if level in (6, -1) else 0 if level in (0, 1) else 1 if level < 6 else 3) << 6
+    flg += 31 - (cmf * 256 + flg) % 31
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8,
+                                                 PNG_COLOR_TYPES[image.mode], 0, 0, 0)))
+        f.write(_png_chunk(b'IDAT', bytes(bytearray([cmf, flg]))))
+
+        for block in deflated:
+            f.write(_png_chunk(b'IDAT', block))
+
+        f.write(_png_chunk(b'IDAT', struct.pack('>I', adler & 0xffffffff)))
+        f.write(_png_chunk(b'IEND', b''))
+
+## Bit layout of each --color-depth, from the high bit down; 0 pads
+RAW_DEPTHS = {
+    'RGBA8': None,
+    'RGB8': None,
+    'RGB565': (('R', 5), ('G', 6), ('B', 5)),
+    'RGB5': ((0, 1), ('R', 5), ('G', 5), ('B', 5)),
+    'RGBA5551': (('R', 5), ('G', 5), ('B', 5), ('A', 1)),
+    'RGBA4': (('R', 4), ('G', 4), ('B', 4), ('A', 4)),
+    'RGB4': (('R', 4), ('G', 4), ('B', 4), (0, 4)),
+}
+
+RAW_MAGIC = b'TXPK'
+RAW_HEADER = '<4sHH8sIIHHIIIII'
+RAW_HEADER_SIZE = 64 ## data starts on a cache line
+RAW_ROW_ALIGN = 4
+
+def pack_pixels(texture, depth):
+    """
+    Return the pixels of `texture` packed in a --color-depth format, with the
+    number of bytes per pixel.  Packed 16-bit formats are little-endian.
+    """
+    texture = texture.convert('RGBA')
+
+    if depth == 'RGBA8':
+        return texture.tobytes(), 4
+
+    if depth == 'RGB8':
+        return texture.convert('RGB').tobytes(), 3
+
+    bands = dict(zip('RGBA', texture.split()))
+    low = high = Image.new('L', texture.size)
+    shift = 16
+
+    for band, bits in RAW_DEPTHS[depth]:
+        shift -= bits
+
+        if band:
+            ## Round each 8-bit value to the nearest `bits` bit value
+            top = (1 << bits) - 1
+            values = [((v * top + 127) // 255) << shift for v in range(256)]
+
+            ## Fields do not overlap, so adding bytes is the same as or-ing them
+            low = ImageChops.add(low, bands[band].point([v & 0xff for v in values]))
+            high = ImageChops.add(high, bands[band].point([v >> 8 for v in values]))
+
+    return Image.merge('LA', (low, high)).tobytes(), 2
+
+def write_raw_texture(textures, filename, depth):
+    """
+    Write a texture, or a list of same-sized textures as the layers of an
+    array, as a fixed-size header followed by the pixels in a --color-depth
+    format, ready to map into memory and upload as is.  Rows are padded to a
+    multiple of RAW_ROW_ALIGN bytes; the header gives the row pitch, and also
+    a block size so block-compressed data fits the same layout.
+    """
+    import struct
+
+    if not isinstance(textures, (list, tuple)):
+        textures = [textures]
+
+    w, h = textures[0].size
+    layers = []
+
+    for texture in textures:
+        data, bpp = pack_pixels(texture, depth)
+
+        stride = w * bpp
+        pitch = -(-stride // RAW_ROW_ALIGN) * RAW_ROW_ALIGN
+
+        if pitch != stride:
+            pad = b'\0' * (pitch - stride)
+            data = b''.join(data[y * stride:(y + 1) * stride] + pad for y in range(h))
+
+        layers.append(data)
+
+    header = struct.pack(RAW_HEADER, RAW_MAGIC, 1, RAW_HEADER_SIZE,
+                         depth.encode('ascii'), w, h, 1, 1, bpp, pitch,
+                         RAW_HEADER_SIZE, sum(len(data) for data in layers),
+                         len(layers))
+
+    with open(filename, 'wb') as f:
+        f.write(header.ljust(RAW_HEADER_SIZE, b'\0'))
+        for data in layers:
+            f.write(data)
+
+def read_raw_texture(filename):
+    """
+    Map a texture written by `write_raw_texture` into memory, and return its
+    header as a dict and a read-only memoryview of its pixel data.  Array
+    layers follow each other, `pitch * height` bytes apart.
+    """
+    import mmap
+    import struct
+
+    with open(filename, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    fields = struct.unpack_from(RAW_HEADER, mapped)
+
+    if fields[0] != RAW_MAGIC:
+        raise ValueError('%s is not a raw texture' % filename)
+
+    header = dict(zip(['magic', 'version', 'header_size', 'format', 'width', 'height',
+                       'block_width', 'block_height', 'block_size', 'pitch',
+                       'offset', 'size', 'layers'], fields))
+    header['format'] = header['format'].rstrip(b'\0').decode('ascii')
+
+    view = memoryview(mapped)[header['offset']:header['offset'] + header['size']]
+
+    return header, view
 
-        palimg = Image.new('P', (1,1))
-        palimg.putpalette(palette, 'RGB')
+## DXGI formats for the --color-depth values a DDS file can hold as is
+DDS_FORMATS = {
+    'RGBA8': 28,  ## DXGI_FORMAT_R8G8B8A8_UNORM
+    'RGB565': 85, ## DXGI_FORMAT_B5G6R5_UNORM
+}
+
+def write_dds(textures, filename, depth):
+    """
+    Write a texture, or a list of same-sized textures, as a DDS texture array
+    with a DX10 header.
+    """
+    import struct
 
-        bands = texture.split()
+    if not isinstance(textures, (list, tuple)):
+        textures = [textures]
 
-        rgb = Image.merge('RGB', bands[:3])
-        alpha = bands[3]
+    if depth not in DDS_FORMATS:
+        raise ValueError('DDS output does not support --color-depth=%s' % depth)
 
-        texture = rgb.quantize(colors, method, 0, palimg)
-        texture.putalpha(alpha)
+    w, h = textures[0].size
+    layers = [pack_pixels(texture, depth) for texture in textures]
+    pitch = w * layers[0][1]
 
-    return texture
+    ## CAPS | HEIGHT | WIDTH | PITCH | PIXELFORMAT; DDSCAPS_TEXTURE
+    header = struct.pack('<4s7I44x', b'DDS ', 124, 0x100f, h, w, pitch, 0, 1)
+    header += struct.pack('<2I4s5I', 32, 0x4, b'DX10', 0, 0, 0, 0, 0)
+    header += struct.pack('<5I', 0x1000, 0, 0, 0, 0)
+    ## format, TEXTURE2D, no flags, array size, unknown alpha mode
+    header += struct.pack('<5I', DDS_FORMATS[depth], 3, 0, len(layers), 0)
+
+    with open(filename, 'wb') as f:
+        f.write(header)
+        for data, _ in layers:
+            f.write(data)
+
+def save_texture(texture, filename, args):
+    """
+    Save a sheet texture, using the PNG encoding options in `args` if it is
+    a PNG.  Images that the threaded encoder cannot write, or with
+    --png-optimize, go through PIL.
+    """
+    if args.format == 'raw':
+        write_raw_texture(texture, filename, args.color_depth)
+        return
+
+    if args.format == 'dds':
+        write_dds(texture, filename, args.color_depth)
+        return
+
+    if args.format != 'png':
+        texture.save(filename)
+        return
+
+    level, strategy, threads = args.png_level, args.png_strategy, args.png_threads
+
+    if args.png_fast:
+        ## Favour encode speed over file size
+        level = 1 if level is None else level
+        threads = 0 if threads is None else threads
+
+    if threads is not None and texture.mode in PNG_COLOR_TYPES and not args.png_optimize:
+        write_png(texture, filename, level, strategy or 'default', args.png_filter, threads or None)
+        return
+
+    options = {}
+
+    if level is not None:
+        options['compress_level'] = level
+
+    if strategy:
+        options['compress_type'] = _png_strategy(strategy)
+
+    if args.png_optimize:
+        options['optimize'] = True
+
+    texture.save(filename, **options)
 
 ################################################################################
 
+def build_index(sheet, texname, size):
+    """
+    Return the index data for a sheet as a dict: the texture name and size,
+    and the texture area of each sprite, with its outline mesh if it has one.
+    Mesh vertices are relative to the unrotated sprite image, and UVs are
+    normalized texture coordinates.  Sprites packed as tiles instead list the
+    texture area and sprite offset of each tile on this sheet as `quads`.
+    Premultiplied textures are marked with `premultiplied`.  Sprites removed
+    by `alias_sprites` are listed with the texture area of the sprite they
+    duplicate, and its name as `alias`.
+    """
+    tw, th = size
+
+    sprites = []
+    tiled = {}
+    sources = []
+
+    for spr in sheet.sprites:
+        frame = sheet.frame(spr)
+
+        if hasattr(spr, 'quads'):
+            for src, x, y in spr.quads:
+                if src.name not in tiled:
+                    tiled[src.name] = {
+                        'name': src.name,
+                        'w': src.image_size[0],
+                        'h': src.image_size[1],
+                        'quads': [],
+                    }
+                    sprites.append(tiled[src.name])
+                    sources.append((src, tiled[src.name]))
+
+                tiled[src.name]['quads'].append({
+                    'x': frame.x,
+                    'y': frame.y,
+                    'w': frame.w,
+                    'h': frame.h,
+                    'rotated': spr.rotated,
+                    'offset': [x, y],
+                })
+            continue
+
+        entry = {
+            'name': spr.name,
+            'x': frame.x,
+            'y': frame.y,
+            'w': frame.w,
+            'h': frame.h,
+            'rotated': spr.rotated,
+        }
+
+        outline = getattr(spr, 'outline', None)
+
+        if outline:
+            ## Unrotated image width; ROTATE_90 maps (x, y) to (y, w - x)
+            iw = frame.h if spr.rotated else frame.w
+
+            uvs = []
+            for x, y in outline:
+                if spr.rotated:
+                    x, y = y, iw - x
+                uvs.append([round(float(frame.x + x) / tw, 6),
+                            round(float(frame.y + y) / th, 6)])
+
+            entry['mesh'] = {
+                'vertices': [list(p) for p in outline],
+                'uvs': uvs,
+                'triangles': [[0, i, i+1] for i in range(1, len(outline) - 1)],
+            }
+
+        sprites.append(entry)
+        sources.append((spr, entry))
+
+    for entry in tiled.values():
+        entry['quads'].sort(key=lambda quad: quad['offset'][::-1])
+
+    for spr, entry in sources:
+        for alias in getattr(spr, 'aliases', ()):
+            sprites.append(dict(entry, name=alias.name, alias=spr.name))
+
+    index = {
+        'texture': os.path.basename(texname),
+        'size': [tw, th],
+        'sprites': sprites,
+    }
+
+    if sheet.premultiply:
+        index['premultiplied'] = True
+
+    return index
+
+def write_index(index, idxname, fmt):
+    import json
+
+    if fmt not in ('default', 'json'):
+        log.warning("Warning: --index=%s is not implemented", fmt)
+        return
+
+    with open(idxname, 'w') as f:
+        json.dump(index, f, indent=1)
+
+################################################################################
+
+## Options that change the output of a sheet with the same sprites and layout
+DIGEST_OPTIONS = ['format', 'color_depth', 'quantize', 'palette_type', 'palette_depth',
+                  'shared_palette', 'dither', 'bleed', 'premultiply', 'debug', 'index',
+                  'png_level', 'png_strategy', 'png_optimize', 'png_threads', 'png_filter',
+                  'png_fast']
+
+def sheet_digest(sheet, texname, args, extra=''):
+    """
+    Return a hex digest of everything that goes into the output of a finished
+    sheet: its index, the content of each sprite, and the output options, plus
+    `extra` for anything shared between sheets.
+    """
+    import hashlib
+    import json
+
+    h = hashlib.sha1()
+    h.update(json.dumps(build_index(sheet, texname, sheet.size), sort_keys=True).encode('utf-8'))
+
+    for spr in sheet.sprites:
+        h.update(spr.digest.encode('ascii'))
+
+    h.update(repr([(name, getattr(args, name, None)) for name in DIGEST_OPTIONS]).encode('utf-8'))
+    h.update(extra.encode('utf-8'))
+
+    return h.hexdigest()
+
+def read_digest(filename):
+    try:
+        with open(filename) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
 def encrypt_data(filename, method, key=None, key_hash=None, key_file=None):
     pass
 
 ################################################################################
 
+def parse_size(text):
+    """
+    Parse a size given as `WxH`, or as `N` for a square.
+    """
+    w, _, h = text.lower().partition('x')
+    size = int(w), int(h or w)
+    if min(size) < 1:
+        raise ValueError(text)
+    return size
+
+def parse_mesh_vertices(text):
+    """
+    Parse a mesh vertex limit; any sprite can be outlined with 4 vertices
+    inside its image, but not always with fewer.
+    """
+    count = int(text)
+    if count < 4:
+        raise ValueError(text)
+    return count
+
 def build_arg_parser():
     import argparse
 
@@ -423,7 +1470,8 @@ def build_arg_parser():
     parser.add_argument('prefix',
                         help="Prefix for output sheet textures")
     parser.add_argument('sprites', nargs='+',
-                        help="Sprite images / folders / wildcards")
+                        help="Sprite images / folders / wildcards / zip or tar archives / "
+                        "JSON manifests")
 
     parser.add_argument('--debug', type=ImageColor.getrgb, nargs='?',
                         default=False, const='#00ff00', metavar='COLOR',
@@ -433,9 +1481,25 @@ def build_arg_parser():
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help="Print more detailed messages.")
 
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Write per-stage timings to %(metavar)s as JSON, "
+                        "or as CSV if %(metavar)s ends in `.csv'.")
+
+    parser.add_argument('--profile-layout', metavar='FILE',
+                        help="Write cProfile statistics for the layout phase to %(metavar)s.")
+
+    parser.add_argument('--watch', type=float, nargs='?', const=0.5, metavar='SECONDS',
+                        help="Keep running and rebuild whenever a sprite changes, "
+                        "checking every %(metavar)s seconds. "
+                        "If %(metavar)s is omitted, defaults to %(const)s.")
+
     ########################################################################
 
     sprite_group = parser.add_argument_group('sprite options')
+    sprite_group.add_argument('--frames', action='store_true', default=False,
+                              help="Load each frame of animated images as a sprite.")
+    sprite_group.add_argument('--strip', type=parse_size, metavar='WxH',
+                              help="Slice sprite strips into %(metavar)s pixel frames.")
     sprite_group.add_argument('--mask', nargs='?', default=False, const='3of4', metavar='MASK',
                               help="Mask sprites against background (color or detection method). "
                               "If %(metavar)s is omitted, defaults to `%(const)s'.")
@@ -444,31 +1508,96 @@ def build_arg_parser():
     sprite_group.add_argument('--alias', type=float, nargs='?', const=0.0, metavar='TOLERANCE',
                               help="Find and remove duplicate sprites. "
                               "If %(metavar)s is omitted, defaults to %(const)s.")
+    sprite_group.add_argument('--tiles', type=int, metavar='SIZE',
+                              help="Split sprites into %(metavar)s pixel square tiles and "
+                              "store identical tiles once; the index lists each sprite "
+                              "as a set of tile quads.")
+    sprite_group.add_argument('--mesh', type=int, nargs='?', const=0, metavar='THRESHOLD',
+                              help="Add a convex outline mesh of the pixels with alpha above "
+                              "%(metavar)s to the index for each sprite. "
+                              "If %(metavar)s is omitted, defaults to %(const)s.")
+    sprite_group.add_argument('--mesh-vertices', type=parse_mesh_vertices, default=8, metavar='COUNT',
+                              help="Simplify outline meshes to at most %(metavar)s vertices, "
+                              "at least 4. (default: %(default)s)")
+    sprite_group.add_argument('--mesh-cache', metavar='FILE',
+                              help="Keep outline meshes in %(metavar)s between builds.")
     sprite_group.add_argument('--extrude', type=int, default=0, nargs='?', const=1, metavar='SIZE',
                               help="Extrude sprite edges %(metavar)s pixels to avoid color bleed. "
                               "If %(metavar)s is omitted, defaults to `%(const)s'.")
+    sprite_group.add_argument('--bleed', type=int, default=0, nargs='?', const=4, metavar='SIZE',
+                              help="Fill transparent pixels up to %(metavar)s pixels from each "
+                              "sprite with the nearest visible color, so filtering and mipmaps "
+                              "do not darken edges; this needs less --extrude and --pad. "
+                              "If %(metavar)s is omitted, defaults to `%(const)s'.")
     sprite_group.add_argument('--pad', type=int, default=0, nargs='?', const=1, metavar='SIZE',
                               help="Insert %(metavar)s pixels of padding between sprites. "
                               "If %(metavar)s is omitted, defaults to `%(const)s'.")
+    sprite_group.add_argument('--border', type=int, default=0, nargs='?', const=1, metavar='SIZE',
+                              help="Leave %(metavar)s pixels of padding around the edge of each sheet. "
+                              "If %(metavar)s is omitted, defaults to `%(const)s'.")
     sprite_group.add_argument('--sort', metavar='ATTR',
                               choices=['width','height','area','name',
                                        'width-asc','height-asc','area-asc','name-asc',
                                        'width-desc','height-desc','area-desc','name-desc',
+                                       'random',
                                        ],
-                              help="Sort sprites by attibute %(metavar)s.")
+                              help="Sort sprites by attibute %(metavar)s, or shuffle them "
+                              "from --seed if %(metavar)s is `random'. Ties keep the order "
+                              "of the sorted file names.")
 
     ########################################################################
 
     layout_group = parser.add_argument_group('layout options')
     layout_group.add_argument('--layout', type=str.lower, default='shelf', metavar='TYPE',
-                              choices=['shelf','stack','max-rects','skyline'],
+                              choices=['shelf','stack','max-rects','guillotine','bitmap','skyline'],
                               help="Select layout algorithm. (default: %(default)s)")
+    layout_group.add_argument('--layout-rule', type=str.lower, metavar='RULE',
+                              choices=['bssf','blsf','baf','bl','cp','nf','ff','bhf'],
+                              help="Select placement rule: best short side fit, best long side fit, "
+                              "best area fit, bottom-left, or contact point for max-rects; "
+                              "bssf, blsf, or baf for guillotine; next fit, first fit, "
+                              "best height fit, or baf for shelf and stack. "
+                              "(default: bssf for max-rects, baf otherwise)")
+    layout_group.add_argument('--split-rule', type=str.lower, metavar='RULE',
+                              choices=['slas','llas','sas','las','minas','maxas'],
+                              help="Select how the guillotine layout splits free space: "
+                              "shorter or longer leftover axis, shorter or longer axis, "
+                              "or minimize or maximize area. (default: slas)")
+    layout_group.add_argument('--group', metavar='KEY',
+                              help="Keep groups of sprites on one sheet where possible: "
+                              "sprites in the same directory if %(metavar)s is `dir', or else "
+                              "with the same match (or first group) of the regular expression "
+                              "%(metavar)s in their names. Manifests may also give groups.")
+    layout_group.add_argument('--cell-size', type=int, default=8, metavar='SIZE',
+                              help="Use %(metavar)s pixel cells for the alpha masks of the "
+                              "bitmap layout; smaller cells nest sprites more tightly "
+                              "but take longer. (default: %(default)s)")
+    layout_group.add_argument('--online', action='store_true', default=False,
+                              help="Place sprites in input order instead of searching "
+                              "for the best sprite to place next.")
     layout_group.add_argument('--rotate', action='store_true', default=False,
                               help="Allow layout engine to rotate sprites.")
     layout_group.add_argument('--npot', action='store_true', default=False,
                               help="Allow non-power-of-two sheet dimensions.")
     layout_group.add_argument('--square', action='store_true', default=False,
                               help="Constrain sheet dimensions to a square.")
+    layout_group.add_argument('--optimize', type=float, nargs='?', const=10.0, metavar='SECONDS',
+                              help="Try several layouts, sort orders and rotation settings, "
+                              "keeping the one with the fewest sheets and best coverage. "
+                              "Stop trying after %(metavar)s seconds; which combinations "
+                              "finish in time depends on the machine, so the result is not "
+                              "reproducible unless they all finish. "
+                              "If %(metavar)s is omitted, defaults to %(const)s.")
+    layout_group.add_argument('--optimize-tries', type=int, metavar='COUNT',
+                              help="Optimize by trying the first %(metavar)s combinations, "
+                              "however long they take, for a reproducible result. "
+                              "Overrides the time limit of --optimize.")
+    layout_group.add_argument('--seed', type=int, default=0,
+                              help="Seed randomized heuristics such as --sort=random, so "
+                              "that builds are reproducible. (default: %(default)s)")
+    layout_group.add_argument('--jobs', type=int, metavar='COUNT',
+                              help="Use up to %(metavar)s worker processes for --optimize, "
+                              "and threads for quantizing sheets. (default: one per CPU)")
     layout_group.add_argument('--min-size', type=int, default=0, metavar='SIZE',
                               help="Set minimum sheet dimensions.")
     layout_group.add_argument('--max-size', type=int, default=0, metavar='SIZE',
@@ -479,9 +1608,12 @@ def build_arg_parser():
     texture_group = parser.add_argument_group('texture options')
     texture_group.add_argument('--scale', action='store_true', default=False,
                                help="Produce full- and half-scale images.")
-    texture_group.add_argument('--color-depth', type=str.lower, default='RGBA8', metavar='DEPTH',
+    texture_group.add_argument('--color-depth', type=str.upper, default='RGBA8', metavar='DEPTH',
                                choices=['RGB4','RGBA4','RGB5','RGB565','RGBA5551','RGB8','RGBA8'],
-                               help="Select color bit-depth. (default: %(default)s)")
+                               help="Select color bit-depth of raw textures. (default: %(default)s)")
+    texture_group.add_argument('--premultiply', action='store_true', default=False,
+                               help="Multiply colors by alpha, for premultiplied alpha blending "
+                               "and filtering.")
     texture_group.add_argument('--compress', type=str.upper, nargs='?', const='S3TC', metavar='TYPE',
                                choices=['S3TC','ETC','PVRTC','ATITC'], help=
                                "Set texture compression. If %(metavar)s is omitted, defaults to `%(const)s'. "
@@ -495,6 +1627,9 @@ def build_arg_parser():
                                help="Select palette type. (default: %(default)s)")
     texture_group.add_argument('--palette-depth', type=int, default=8, choices=[1,2,4,8], metavar='DEPTH',
                                help="Select palette bit-depth. (default: %(default)s)")
+    texture_group.add_argument('--shared-palette', action='store_true', default=False,
+                               help="Quantize all sheets against one palette built from a "
+                               "sample of all sprites.")
     texture_group.add_argument('--dither', type=str.lower, nargs='?', const='void-cluster', metavar='TYPE',
                                choices=['random','halftone','bayer','void-cluster','diffusion'],
                                help="Select dithering method for indexed textures. "
@@ -504,7 +1639,37 @@ def build_arg_parser():
 
     data_group = parser.add_argument_group('data options')
     data_group.add_argument('--format', type=str.lower, default='png',
-                            help="Select default output texture format.")
+                            help="Select default output texture format. `raw' writes a "
+                            "header and uncompressed pixels in --color-depth, "
+                            "to be memory-mapped; `dds' writes a DX10 DDS texture "
+                            "in RGBA8 or RGB565.")
+    data_group.add_argument('--png-level', type=int, choices=range(10), metavar='LEVEL',
+                            help="Set PNG compression level from 0 (none) to 9 (smallest). "
+                            "(default: 6)")
+    data_group.add_argument('--png-strategy', type=str.lower, choices=PNG_STRATEGIES,
+                            metavar='STRATEGY',
+                            help="Select the zlib strategy for PNG compression: "
+                            "%s. (default: default)" % ', '.join(PNG_STRATEGIES))
+    data_group.add_argument('--png-optimize', action='store_true', default=False,
+                            help="Spend extra time to make PNG files as small as possible.")
+    data_group.add_argument('--png-threads', type=int, nargs='?', const=0, metavar='COUNT',
+                            help="Deflate PNG row blocks on %(metavar)s threads. "
+                            "If %(metavar)s is omitted or 0, uses several per CPU.")
+    data_group.add_argument('--png-filter', type=str.lower, default='up',
+                            choices=sorted(PNG_FILTERS), metavar='FILTER',
+                            help="Select the row filter for --png-threads: none, sub, or up. "
+                            "(default: %(default)s)")
+    data_group.add_argument('--png-fast', action='store_true', default=False,
+                            help="Favour PNG encoding speed over file size, for quick iterations. "
+                            "Implies --png-level=1 --png-threads.")
+    data_group.add_argument('--array', action='store_true', default=False,
+                            help="Save all sheets as the layers of one array texture, "
+                            "padded to the same size; the index gives each sprite's layer. "
+                            "Needs --format=raw or --format=dds.")
+    data_group.add_argument('--force', action='store_true', default=False,
+                            help="Save every sheet, even if its output on disk is unchanged. "
+                            "Otherwise sheets whose sprites, layout and options match the "
+                            "digest saved with them are kept as they are.")
     data_group.add_argument('--index', default='default',
                             help="Select output sprite index format.")
     data_group.add_argument('--encrypt', type=str.lower, metavar='TYPE',
@@ -524,45 +1689,77 @@ def build_arg_parser():
 
 ################################################################################
 
-def load_and_process_sprites(args):
+## Outlines computed in this process, shared by builds in --watch and --serve
+MESH_CACHE = {}
+
+def load_and_process_sprites(args, cache=None):
 
-    sprites = load_sprites(args.sprites)
+    ## Images are cached after the per-sprite stages that depend on these
+    key = args.mask, args.trim
+
+    sprites = load_sprites(args.sprites, cache, key, args.frames, args.strip)
 
     if not sprites:
         raise ValueError('No sprites found.')
 
+    return process_sprites(args, sprites, cache, key)
+
+def process_sprites(args, sprites, cache=None, key=None):
+    """
+    Run the per-sprite stages asked for in `args` on loaded sprites, and
+    return the sprites to lay out.  The sheet of aliased sprites is only saved
+    when there is an output `prefix`.
+    """
+    fresh = [spr for spr in sprites if not hasattr(spr, 'cached')]
+
     if args.mask:
         ## Mask sprites against background color
-        sprites = mask_sprites(sprites, args.mask)
+        mask_sprites(fresh, args.mask)
 
     if args.trim:
         ## Trim sprites to visible area
-        sprites = trim_sprites(sprites)
-    else:
-        ## Generate hashes of trimmed sprites
-        sprites = hash_sprites(sprites)
+        trim_sprites(fresh)
+
+    if cache is not None:
+        for spr in fresh:
+            if hasattr(spr, 'filename'):
+                cache.put(spr.filename, key, spr.image)
 
     if args.alias is not None:
         ## Find and remove duplicate sprites
         sprites, aliased = alias_sprites(sprites, args.alias)
 
-        if aliased:
+        if aliased and args.prefix is not None:
             sheet = Sheet(npot=True, layout=get_layout('stack'))
             sheet.add(aliased)
             texture = sheet.prepare(args.debug)
             texname = '%salias.png' % args.prefix
             texture.save(texname)
 
-    if args.extrude:
-        ## Extrude sprite edges to avoid color bleed
-        sprites = extrude_sprites(sprites, args.extrude)
+    if args.mesh is not None:
+        ## Generate outline meshes to cut overdraw
+        mesh_cache = MESH_CACHE
+        if args.mesh_cache:
+            mesh_cache = load_mesh_cache(args.mesh_cache)
+
+        sprites = mesh_sprites(sprites, args.mesh, args.mesh_vertices, mesh_cache)
+
+        if args.mesh_cache:
+            save_mesh_cache(args.mesh_cache, mesh_cache)
+
+    if args.group:
+        ## Keep related sprites on one sheet
+        sprites = group_sprites(sprites, args.group)
 
-    if args.pad:
-        ## Insert transparent padding between sprites
-        sprites = pad_sprites(sprites, args.pad)
+    if args.tiles:
+        ## Pack shared tiles in place of whole sprites
+        if args.mesh is not None:
+            log.warning("Warning: --mesh is ignored with --tiles")
+
+        sprites = tile_sprites(sprites, args.tiles)
 
     if args.sort:
-        sprites = sort_sprites(sprites, args.sort, args.rotate)
+        sprites = sort_sprites(sprites, args.sort, args.rotate, args.seed)
 
     return sprites
 
@@ -574,52 +1771,295 @@ def build_sprite_sheets(args, sprites):
 
     layout = get_layout(args.layout)
 
+    def new_sheet():
+        return Sheet(
+            min_size = args.min_size,
+            max_size = args.max_size,
+            rotate = args.rotate,
+            npot = args.npot,
+            square = args.square,
+            layout = layout,
+            rule = args.layout_rule,
+            split_rule = args.split_rule,
+            extrude = args.extrude,
+            padding = args.pad,
+            border = args.border,
+            online = args.online,
+            cell_size = args.cell_size,
+            bleed = args.bleed,
+            premultiply = args.premultiply
+        )
+
     oldlen = 0
 
-    with Timer('generate sheet layouts'):
+    with Timer('generate sheet layouts') as timer:
+        timer.counts['sprites'] = len(sprites)
+
         while sprites and len(sprites) != oldlen:
             oldlen = len(sprites)
 
-            sheet = Sheet(
-                min_size = args.min_size,
-                max_size = args.max_size,
-                rotate = args.rotate,
-                npot = args.npot,
-                square = args.square,
-                layout = layout
-            )
+            sheet = new_sheet()
+            remain = sheet.add(sprites)
+
+            split = set(getattr(spr, 'group', None) for spr in remain) & \
+                    set(getattr(spr, 'group', None) for spr in sheet.sprites)
+            split.discard(None)
+
+            if split:
+                sheet = keep_groups_whole(sheet, sprites, split, new_sheet)
+                placed = set(id(spr) for spr in sheet.sprites)
+                remain = [spr for spr in sprites if id(spr) not in placed]
 
-            sprites = sheet.add(sprites)
+            sprites = remain
 
             if sheet.sprites:
                 sheets.append(sheet)
 
+        timer.counts['sheets'] = len(sheets)
+
     if sprites:
         log.warn("Could not place:")
         for spr in sprites:
             log.warn("\t%s", spr.name)
 
+    report_split_groups(sheets)
+
     return sheets
 
+def keep_groups_whole(sheet, sprites, split, new_sheet):
+    """
+    Return a sheet laid out with the sprites placed on `sheet` that are not in
+    one of the `split` groups, and then as many of those groups as fit whole,
+    trying each in turn on a fresh sheet from `new_sheet()`.  Returns `sheet`
+    itself if that would leave nothing on it.
+
+    Trial sheets share the sprites, so the placement of the sheet returned is
+    saved and put back after the trials that follow it.
+    """
+    def placement(sheet):
+        return [(spr, spr.x, spr.y, spr.rotated) for spr in sheet.sprites]
+
+    def restore(saved):
+        for spr, x, y, rotated in saved:
+            if spr.rotated != rotated:
+                spr.rotate()
+            spr.x, spr.y = x, y
+
+    saved = placement(sheet)
+    kept = [spr for spr in sheet.sprites if getattr(spr, 'group', None) not in split]
+
+    best = None
+    if kept:
+        best = new_sheet()
+        if best.add(kept):
+            restore(saved)
+            return sheet
+
+    members = {}
+    order = []
+
+    for spr in sprites:
+        group = getattr(spr, 'group', None)
+        if group in split:
+            if group not in members:
+                members[group] = []
+                order.append(group)
+            members[group].append(spr)
+
+    best_saved = best and placement(best)
+
+    for group in order:
+        trial = new_sheet()
+        if not trial.add(kept + members[group]):
+            best = trial
+            best_saved = placement(best)
+            kept = kept + members[group]
+
+    if best is None:
+        restore(saved)
+        return sheet
+
+    restore(best_saved)
+    return best
+
+def report_split_groups(sheets):
+    """
+    Log each sprite group that is spread over more than one sheet, and return
+    a dict of those groups and their sheet numbers.
+    """
+    groups = {}
+
+    for i, sheet in enumerate(sheets):
+        for spr in sheet.sprites:
+            group = getattr(spr, 'group', None)
+            if group is not None:
+                groups.setdefault(group, set()).add(i)
+
+    split = dict((group, sorted(numbers)) for group, numbers in groups.items()
+                 if len(numbers) > 1)
+
+    for group in sorted(split):
+        log.warning('Warning: group %s is split across sheets %s', group,
+                    ', '.join(str(i) for i in split[group]))
+
+    return split
+
 ################################################################################
 
-def main(*argv):
-    parser = build_arg_parser()
+class SpriteBox(Sprite):
+    """
+    Stand-in for a Sprite that has a size but no image, used to try out layouts
+    in worker processes without sending any pixel data.
+    """
 
-    args = parser.parse_args(argv)
+    def __init__(self, w, h, name=None, rotated=False):
+        Rect.__init__(self, w, h)
+        self.name = name
+        self.extrude = 0
+        self.pad = 0
+        self.rotated = rotated
 
-    if args.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
+def _try_layout(args, boxes):
+    total = len(boxes)
+
+    boxes = [SpriteBox(*box) for box in boxes]
+
+    if args.sort:
+        boxes = sort_sprites(boxes, args.sort, args.rotate, args.seed)
+
+    sheets = build_sprite_sheets(args, boxes)
+
+    used = area = placed = 0
+
+    for sheet in sheets:
+        sheet.finish()
+        placed += len(sheet.sprites)
+        used += sum(spr.w * spr.h for spr in sheet.sprites)
+        area += sheet.size[0] * sheet.size[1]
+
+    return total - placed, len(sheets), float(used) / float(area or 1)
+
+def optimize_layout(args, sprites):
+    """
+    Try combinations of layout, sort order and rotation on a process pool, and
+    return a copy of `args` with the combination that leaves the fewest sprites
+    unplaced, then uses the fewest sheets, then has the highest coverage.
+    Combinations still running when the time budget runs out are abandoned,
+    unless a number of tries is given instead, which makes the choice
+    independent of machine speed.
+    """
+    import argparse
+    import multiprocessing
+
+    boxes = [(spr.w, spr.h, spr.name, spr.rotated) for spr in sprites]
+
+    candidates = []
+
+    for layout in ['shelf', 'stack', 'max-rects', 'guillotine']:
+        for rule in get_layout(layout).RULES or [None]:
+            for sort in [args.sort, 'width', 'height', 'area', 'name']:
+                for rotate in ([False, True] if args.rotate else [False]):
+                    option = argparse.Namespace(**vars(args))
+                    option.layout = layout
+                    option.layout_rule = rule
+                    option.split_rule = None
+                    option.sort = sort
+                    option.rotate = rotate
+                    if option not in candidates:
+                        candidates.append(option)
+
+    if args.optimize_tries:
+        candidates = candidates[:args.optimize_tries]
+
+    best, best_score = None, None
+
+    with Timer('optimize layout') as timer:
+        timer.counts['sprites'] = len(sprites)
+
+        pool = multiprocessing.Pool(args.jobs)
+        results = [pool.apply_async(_try_layout, (option, boxes))
+                   for option in candidates]
+        deadline = None
+        if not args.optimize_tries:
+            deadline = time.time() + args.optimize
+
+        try:
+            for i, result in enumerate(results):
+                try:
+                    unplaced, numsheets, coverage = result.get(
+                        None if deadline is None else max(0, deadline - time.time()))
+                except multiprocessing.TimeoutError:
+                    log.info('optimize: time budget exhausted after %d of %d '
+                             'combinations', i, len(results))
+                    break
+
+                option = candidates[i]
+                log.debug('optimize: %s/%s/%s/%s: %d sheets, %.1f%% coverage',
+                          option.layout, option.layout_rule, option.sort,
+                          option.rotate, numsheets, 100*coverage)
+
+                score = unplaced, numsheets, -coverage
+                if best_score is None or score < best_score:
+                    best, best_score = option, score
+
+        finally:
+            ## Abandon any combinations still running
+            pool.terminate()
+            pool.join()
+
+    if best is None:
+        return args
+
+    log.info('optimize: using --layout=%s%s --sort=%s%s (%d sheets, %.1f%% coverage)',
+             best.layout, ' --layout-rule=%s' % best.layout_rule if best.layout_rule else '',
+             best.sort, ' --rotate' if best.rotate else '',
+             best_score[1], -100*best_score[2])
+
+    return best
+
+################################################################################
+
+def arrange_sprites(args, sprites):
+    """
+    Lay out sprites in sheets, first choosing the layout options if asked to
+    optimize, and return the options used and the sheets.
+    """
+    if args.optimize or args.optimize_tries:
+        sort = args.sort
+        args = optimize_layout(args, sprites)
+
+        if args.sort and args.sort != sort:
+            sprites = sort_sprites(sprites, args.sort, args.rotate, args.seed)
+
+    if args.profile_layout:
+        import cProfile
+        profiler = cProfile.Profile()
+        sheets = profiler.runcall(build_sprite_sheets, args, sprites)
+        profiler.dump_stats(args.profile_layout)
+    else:
+        sheets = build_sprite_sheets(args, sprites)
+
+    return args, sheets
+
+def run(args, cache=None):
+    with Profile() as profile:
+        with Timer('total'):
+            build(args, cache)
+
+    if args.profile:
+        profile.save(args.profile)
+
+def build(args, cache=None):
 
     ########################################################################
     ## Phase 1 - Load and process individual sprites
 
-    sprites = load_and_process_sprites(args)
+    sprites = load_and_process_sprites(args, cache)
 
     ########################################################################
     ## Phase 2 - Arrange sprites in sheets
 
-    sheets = build_sprite_sheets(args, sprites)
+    args, sheets = arrange_sprites(args, sprites)
 
     ########################################################################
     ## Phase 3 - Scale, quantize, and compress textures
@@ -634,6 +2074,12 @@ def main(*argv):
         ## ignore most of the other options and generate compressed textures
         log.warn("Warning: --compress is not implemented")
 
+    if args.dither and args.dither != 'diffusion':
+        log.warning("Warning: --dither=%s is not implemented", args.dither)
+
+    if args.array and args.format not in ('raw', 'dds'):
+        raise ValueError('--array needs --format=raw or --format=dds')
+
     numsheets = len(sheets)
 
     if numsheets > 0:
@@ -642,47 +2088,458 @@ def main(*argv):
         log.info('%d sheet%s', numsheets, ':' if numsheets == 1 else 's:')
 
         path = os.path.dirname(args.prefix)
-        if path and not os.path.isdir(path):
-            os.makedirs(path)
+        if path:
+            os.makedirs(path, exist_ok=True)
 
     else:
         log.warning('%d sheets', numsheets)
         digits = 0
 
-    with Timer('save sheets'):
-        for i, sheet in enumerate(sheets):
-            if not sheet.sprites:
-                continue
+    def output_names(i):
+        outname = '%s%0*d' % (args.prefix, digits, i)
+        return outname + '.' + args.format, outname + '.' + 'idx', outname + '.' + 'digest'
 
-            texture = sheet.prepare(args.debug)
+    profile = Profile.current()
+
+    for i, sheet in enumerate(sheets):
+        if not sheet.sprites:
+            continue
+
+        sheet.finish()
+
+        if profile is not None:
+            profile.add({'stage': 'layout sheet %d' % i,
+                         'sprites': len(sheet.sprites),
+                         'passes': sheet.passes})
+
+    ## Sheets whose digest matches the one stored with their output on disk
+    ## are not composited or saved again
+    digests = {}
+    reused = set()
+
+    if not (args.array or args.encrypt):
+        with Timer('digest sheets') as timer:
+            extra = ''
+
+            if args.quantize and args.shared_palette:
+                ## The shared palette depends on every sprite
+                extra = ' '.join(spr.digest for sheet in sheets for spr in sheet.sprites)
+
+            for i, sheet in enumerate(sheets):
+                if not sheet.sprites:
+                    continue
+
+                texname, idxname, digname = output_names(i)
+                digests[i] = sheet_digest(sheet, texname, args, extra)
+
+                if not args.force and digests[i] == read_digest(digname) and \
+                        os.path.exists(texname) and os.path.exists(idxname):
+                    log.info("\t%s (unchanged)", texname)
+                    reused.add(i)
+
+                    ## Only hashed, never composited
+                    for spr in sheet.sprites:
+                        spr.release()
+
+            timer.counts['reused'] = len(reused)
+
+        if reused:
+            log.info('%d of %d sheets unchanged, reused', len(reused), numsheets)
+
+    palette = None
+
+    if args.quantize and args.shared_palette and len(reused) < numsheets:
+        palette = build_palette([spr for sheet in sheets for spr in sheet.sprites],
+                                args.quantize, args.palette_type, args.palette_depth)
 
-            texture = quantize_texture(texture, args.quantize, args.palette_type, args.palette_depth, args.dither)
+    layers = []
+
+    with Timer('save sheets') as timer:
+        timer.counts['sheets'] = numsheets
+
+        for i, sheet, texture in prepare_sheets(sheets, args, palette, reused):
+            if args.array:
+                ## Saved together once all sheets are ready
+                layers.append((sheet, texture))
+                continue
 
     ########################################################################
     ## Phase 4 - Output texture data; create index
 
-            outname = '%s%0*d' % (args.prefix, digits, i)
-            texname = outname + '.' + args.format
-            idxname = outname + '.' + 'idx'
+            texname, idxname, digname = output_names(i)
 
             log.info("\t%s (%dx%d, %d sprites, %.1f%% coverage)",
                 texname, texture.size[0], texture.size[1], len(sheet.sprites),
                 100*sheet.coverage)
 
-            if sheet.coverage > 1.0:
+            if sheet.coverage > 1.0 and not sheet.layout.overlapping:
                 log.warning('coverage > 1.0, overlapping sprites?')
 
-            texture.save(texname)
+            save_texture(texture, texname, args)
+
+            write_index(build_index(sheet, texname, texture.size), idxname, args.index)
 
             if args.encrypt:
                 encrypt_data(texname, args.encrypt, args.key, args.key_hash, args.key_file)
                 encrypt_data(idxname, args.encrypt, args.key, args.key_hash, args.key_file)
 
+            if i in digests:
+                ## Written last, so an interrupted save is redone next time
+                with open(digname, 'w') as f:
+                    f.write(digests[i] + '\n')
+
+        if layers:
+            save_texture_array(layers, args)
+
+def prepare_sheets(sheets, args, palette=None, skip=()):
+    """
+    Yield (i, sheet, texture) in order for each sheet with sprites, except the
+    indices in `skip`, with its texture composited and then quantized, if
+    asked for, on a thread pool while the next sheets are composited.
+    """
+    import multiprocessing
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    profile = Profile.current()
+    workers = args.jobs or multiprocessing.cpu_count()
+    pending = deque()
+
+    with ThreadPoolExecutor(workers) as pool:
+        for i, sheet in enumerate(sheets):
+            if not sheet.sprites or i in skip:
+                continue
+
+            texture = sheet.prepare(args.debug)
+
+            for spr in sheet.sprites:
+                spr.release()
+
+            if not args.quantize:
+                yield i, sheet, texture
+                continue
+
+            pending.append((i, sheet, pool.submit(quantize_texture, texture, args.quantize,
+                                                  args.palette_type, args.palette_depth,
+                                                  args.dither, palette, profile)))
+
+            if len(pending) > workers:
+                i, sheet, future = pending.popleft()
+                yield i, sheet, future.result()
+
+        while pending:
+            i, sheet, future = pending.popleft()
+            yield i, sheet, future.result()
+
+def pack(sprites, options=()):
+    """
+    Pack sprites in memory, without reading or writing any files, and return
+    a list of the composited sheet images and a list of their index dicts, as
+    written by `main`.
+
+    `sprites` is a dict, or a list of pairs, of sprite names and images.  Each
+    image may be a PIL image, the data of an image file as bytes, or raw pixel
+    data as a tuple of mode, size and bytes.  `options` is a list of command
+    line options, such as `['--trim', '--max-size=512']`.
+    """
+    import io
+
+    try:
+        args = build_arg_parser().parse_args(['-', '-'] + list(options))
+    except SystemExit:
+        raise ValueError('invalid options: %r' % (options,))
+
+    args.prefix = None
+    args.sprites = []
+
+    if isinstance(sprites, dict):
+        sprites = sprites.items()
+
+    loaded = []
+
+    for name, image in sprites:
+        if isinstance(image, tuple):
+            mode, size, data = image
+            image = Image.frombytes(mode, tuple(size), bytes(data))
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            image = io.BytesIO(bytes(image))
+
+        if isinstance(image, Image.Image):
+            ## Processing may change the sprite image in place
+            image = image.convert('RGBA') if image.mode != 'RGBA' else image.copy()
+
+        spr = Sprite(image, name=name)
+        spr.path = name
+        spr.group = None
+        loaded.append(spr)
+
+    if not loaded:
+        raise ValueError('No sprites found.')
+
+    sprites = process_sprites(args, loaded)
+    args, sheets = arrange_sprites(args, sprites)
+
+    palette = None
+
+    if args.quantize and args.shared_palette:
+        palette = build_palette([spr for sheet in sheets for spr in sheet.sprites],
+                                args.quantize, args.palette_type, args.palette_depth)
+
+    textures = []
+    index = []
+
+    for i, sheet, texture in prepare_sheets(sheets, args, palette):
+        textures.append(texture)
+        index.append(build_index(sheet, '%d.%s' % (i, args.format), texture.size))
+
+    return textures, index
+
+def save_texture_array(layers, args):
+    """
+    Save a list of (sheet, texture) as the layers of one array texture, with
+    every layer padded to the largest sheet size, and one index giving the
+    layer of each sprite.
+    """
+    w = max(texture.size[0] for _, texture in layers)
+    h = max(texture.size[1] for _, texture in layers)
+
+    textures = []
+
+    for sheet, texture in layers:
+        if texture.size != (w, h):
+            layer = Image.new('RGBA', (w, h))
+            layer.paste(texture.convert('RGBA'), (0, 0))
+            texture = layer
+        textures.append(texture)
+
+    texname = '%sarray.%s' % (args.prefix, args.format)
+    idxname = '%sarray.idx' % args.prefix
+
+    log.info("\t%s (%dx%d, %d layers, %d sprites)", texname, w, h, len(layers),
+             sum(len(sheet.sprites) for sheet, _ in layers))
+
+    save_texture(textures, texname, args)
+
+    index = None
+
+    for i, (sheet, _) in enumerate(layers):
+        entry = build_index(sheet, texname, (w, h))
+
+        for spr in entry['sprites']:
+            spr['layer'] = i
+
+        if index is None:
+            index = entry
+            index['layers'] = len(layers)
+        else:
+            index['sprites'].extend(entry['sprites'])
+
+    write_index(index, idxname, args.index)
+
+    if args.encrypt:
+        encrypt_data(texname, args.encrypt, args.key, args.key_hash, args.key_file)
+        encrypt_data(idxname, args.encrypt, args.key, args.key_hash, args.key_file)
+
+################################################################################
+
+def watch(args):
+    cache = SpriteCache()
+    stamps = None
+
+    log.info('watching for changes (press Ctrl+C to stop)')
+
+    try:
+        while True:
+            current = {}
+
+            for f in find_sprite_files(args.sprites):
+                files = [f]
+
+                ## Watch the sprites a manifest lists as well as the manifest
+                if f.lower().endswith('.json'):
+                    files += [entry['path'] for entry in read_manifest(f)]
+
+                for ff in files:
+                    try:
+                        current[ff] = SpriteCache.stamp(ff)
+                    except OSError:
+                        pass
+
+            if current != stamps:
+                if stamps is not None:
+                    changed = set(current.items()) ^ set(stamps.items())
+                    numchanged = len(set(f for f, _ in changed))
+                    log.info('%d file%s changed, rebuilding', numchanged,
+                             '' if numchanged == 1 else 's')
+
+                stamps = current
+
+                try:
+                    with Timer('rebuild') as timer:
+                        run(args, cache)
+                    log.info('rebuilt in %s', strfdelta(timer.finish - timer.start))
+                except (IOError, ValueError) as e:
+                    log.error('%s', e)
+
+                cache.prune(current)
+
+            time.sleep(args.watch)
+
+    except KeyboardInterrupt:
+        pass
+
+################################################################################
+
+class JobServer(object):
+    """
+    Runs build jobs, given as argument lists for main(), concurrently on a pool
+    of worker threads in one process.  Decoded sprites are shared between jobs
+    that reference the same files.
+
+    Jobs are read as JSON lines, each either a list of arguments or an object
+    with "args" and an optional "id"; one JSON result line is written per job.
+    """
+
+    def __init__(self, workers=None, cache_size=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.cache = SpriteCache(keep_decoded=True, max_bytes=cache_size)
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def run_job(self, jobid, argv):
+        result = {'id': jobid}
+
+        try:
+            with Timer('job %s' % jobid) as timer:
+                run(build_arg_parser().parse_args(argv), self.cache)
+            result['status'] = 'ok'
+            result['time'] = (timer.finish - timer.start).total_seconds()
+        except SystemExit:
+            result['status'] = 'error'
+            result['error'] = 'invalid arguments'
+        except Exception as e:
+            log.exception('job %s failed', jobid)
+            result['status'] = 'error'
+            result['error'] = str(e)
+
+        return result
+
+    def handle(self, infile, outfile):
+        import json
+
+        def respond(result):
+            with self.lock:
+                outfile.write(json.dumps(result) + '\n')
+                outfile.flush()
+
+        def job(jobid, argv):
+            respond(self.run_job(jobid, argv))
+
+        futures = []
+
+        for n, line in enumerate(infile):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line)
+                if isinstance(request, list):
+                    request = {'args': request}
+                jobid = request.get('id', n)
+                argv = [str(arg) for arg in request['args']]
+            except (ValueError, TypeError, KeyError, AttributeError):
+                respond({'id': None, 'status': 'error', 'error': 'bad request'})
+                continue
+
+            futures.append(self.pool.submit(job, jobid, argv))
+
+        for future in futures:
+            future.result()
+
+    def serve_socket(self, path):
+        import io
+        import socketserver
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.handle(io.TextIOWrapper(self.rfile, 'utf-8'),
+                              io.TextIOWrapper(self.wfile, 'utf-8'))
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        listener = Server(path, Handler)
+
+        try:
+            listener.serve_forever()
+        finally:
+            listener.server_close()
+            os.unlink(path)
+
+def serve(*argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(usage='%(prog)s --serve [options]')
+    parser.add_argument('--socket', metavar='PATH',
+                        help="Accept jobs on Unix socket %(metavar)s instead of stdin.")
+    parser.add_argument('--workers', type=int, metavar='COUNT',
+                        help="Run up to %(metavar)s jobs at once.")
+    parser.add_argument('--cache-size', type=int, default=512, metavar='MB',
+                        help="Keep at most %(metavar)s megabytes of decoded sprites "
+                        "between jobs, dropping the least recently used. (default: %(default)s)")
+    parser.add_argument('--verbose', '-v', action='count', default=0,
+                        help="Print more detailed messages.")
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    server = JobServer(args.workers, args.cache_size << 20)
+
+    try:
+        if args.socket:
+            server.serve_socket(args.socket)
+        else:
+            server.handle(sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+################################################################################
+
+def main(*argv):
+    parser = build_arg_parser()
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if args.watch:
+        watch(args)
+    else:
+        run(args)
+
 ################################################################################
 
 if __name__ == '__main__':
-    import sys
-    main(*sys.argv[1:])
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] == ['--serve']:
+        serve(*sys.argv[2:])
+    else:
+        main(*sys.argv[1:])
 
 ################################################################################
 ## EOF